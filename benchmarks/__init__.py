@@ -0,0 +1,129 @@
+"""Benchmarks for gbatchy. These aren't installed with the package; run them from a checkout, e.g.
+
+python -m benchmarks.micro --save baseline.json
+python -m benchmarks.micro --compare baseline.json
+
+Results are saved as {benchmark name: {metric: value}} JSON files. compare() flags any benchmark
+whose ops/s dropped (or whose net live objects per op grew) by more than the threshold."""
+import argparse
+import gc
+import json
+import sys
+import time
+
+timer = time.time if sys.platform != 'win32' else time.clock
+
+
+class Section(object):
+    """For benchmarks that need some setup: only the time spent (and objects left alive) in
+    `with section:` blocks is counted if the benchmark returns the section."""
+    __slots__ = ['duration', 'live_objects', '_start', '_start_objects']
+
+    def __init__(self):
+        self.duration = 0
+        self.live_objects = 0
+
+    def __enter__(self):
+        self._start_objects = gc.get_count()[0]
+        self._start = timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration += timer() - self._start
+        self.live_objects += gc.get_count()[0] - self._start_objects
+
+
+def measure(fn, n, repeat=3):
+    """Runs fn(n) (which does n operations) repeat times and returns the best ops/s, along with
+    the net number of gc-tracked objects per op that are still alive at the end of the run.
+
+    Python 2 has no tracemalloc, so this is the change of gc.get_count() while the gc is disabled:
+    objects that are allocated and freed during the run don't count, so it is not the number of
+    allocations. It mostly catches objects that get kept around (e.g. refcycles or caches)."""
+    best = None
+    live_objects = None
+    for _ in xrange(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            before = gc.get_count()[0]
+            start = timer()
+            section = fn(n)
+            duration = timer() - start
+            alive = gc.get_count()[0] - before
+        finally:
+            gc.enable()
+
+        if isinstance(section, Section):
+            duration, alive = section.duration, section.live_objects
+        alive = max(0, alive)  # Freeing objects from before the run makes it go down.
+
+        if best is None or duration < best:
+            best = duration
+        if live_objects is None or alive < live_objects:
+            live_objects = alive
+
+    return {'ops_per_sec': n / best if best > 0 else float('inf'),
+            'live_objects_per_op': float(live_objects) / n}
+
+
+def compare(results, baseline, threshold=0.1):
+    """Returns a list of (name, metric, baseline value, new value) that regressed by more than
+    threshold (a fraction) compared to baseline."""
+    regressions = []
+    for name, metrics in sorted(results.iteritems()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if metrics['ops_per_sec'] < old['ops_per_sec'] * (1 - threshold):
+            regressions.append((name, 'ops_per_sec', old['ops_per_sec'], metrics['ops_per_sec']))
+        # Baselines saved before the metric was renamed from allocs_per_op don't have it.
+        if ('live_objects_per_op' in old and
+                metrics['live_objects_per_op'] > old['live_objects_per_op'] * (1 + threshold) + 0.5):
+            regressions.append((name, 'live_objects_per_op', old['live_objects_per_op'],
+                                metrics['live_objects_per_op']))
+    return regressions
+
+
+def report(results, baseline=None, out=sys.stdout):
+    out.write('%-40s %14s %12s %10s\n' % ('benchmark', 'ops/s', 'live objs/op', 'vs base'))
+    for name, metrics in sorted(results.iteritems()):
+        change = ''
+        if baseline and name in baseline:
+            change = '%+.1f%%' % ((metrics['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1) * 100)
+        out.write('%-40s %14.1f %12.2f %10s\n' % (name, metrics['ops_per_sec'], metrics['live_objects_per_op'], change))
+
+
+def main(benchmarks, argv=None):
+    """Command line entry point for a {name: (fn, n)} dict of benchmarks."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--filter', help='Only run benchmarks whose name contains this.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the number of ops of each benchmark.')
+    parser.add_argument('--save', help='Saves the results to this JSON file.')
+    parser.add_argument('--compare', help='Compares the results to this JSON baseline; exits with 1 on regressions.')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, (fn, n) in sorted(benchmarks.iteritems()):
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(fn, max(1, int(n * args.scale)), repeat=args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, old, new in regressions:
+            sys.stdout.write('REGRESSION %s %s: %.2f -> %.2f\n' % (name, metric, old, new))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,82 @@
+"""In-process stand-ins for the redis and memcached clients wrapped by BatchRedisClient and
+BatchMemcachedClient. Every round trip sleeps for `latency` (plus `per_key` for each key or
+command in it), cooperatively, like waiting on a socket would."""
+import gevent
+
+
+class FakeBackend(object):
+    def __init__(self, latency=0.001, per_key=0.00001):
+        self.latency = latency
+        self.per_key = per_key
+        self.data = {}
+        self.calls = 0  # Round trips
+        self.keys = 0  # Keys or commands sent, over all round trips
+
+    def _round_trip(self, n):
+        self.calls += 1
+        self.keys += n
+        gevent.sleep(self.latency + self.per_key * n)
+
+    def reset_counters(self):
+        self.calls = 0
+        self.keys = 0
+
+
+class FakeMemcached(FakeBackend):
+    """Implements the pylibmc methods BatchMemcachedClient batches."""
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        self._round_trip(len(keys))
+        return {k: self.data[k] for k in keys if k in self.data}
+
+    def set_multi(self, mapping, time=0):
+        self._round_trip(len(mapping))
+        self.data.update(mapping)
+        return []
+
+    def add_multi(self, mapping, time=0):
+        self._round_trip(len(mapping))
+        failed = [k for k in mapping if k in self.data]
+        for k, v in mapping.iteritems():
+            self.data.setdefault(k, v)
+        return failed
+
+
+class FakeRedis(FakeBackend):
+    """Implements pipeline() with get/set/delete/incr, which is all BatchRedisClient needs."""
+
+    def pipeline(self, **kwargs):
+        return _FakePipeline(self)
+
+
+class _FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append(lambda data: data.get(key))
+
+    def set(self, key, value):
+        self.commands.append(lambda data: data.__setitem__(key, value) or True)
+
+    def delete(self, key):
+        self.commands.append(lambda data: int(data.pop(key, None) is not None))
+
+    def incr(self, key, amount=1):
+        def incr(data):
+            data[key] = int(data.get(key, 0)) + amount
+            return data[key]
+        self.commands.append(incr)
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        self.redis._round_trip(len(commands))
+        return [command(self.redis.data) for command in commands]
@@ -0,0 +1,136 @@
+"""A load simulation: many concurrent requests (each its own batch context) walk a tree of
+lookups against fake memcached & redis backends, through BatchMemcachedClient and BatchRedisClient.
+
+Every node of the tree fetches keys_per_level keys from memcached (one get_multi) and from redis
+(one get per key), then fans out to `fanout` children until `depth` levels deep. Results are
+reported for each scheduler: throughput, request latency percentiles, and the number of rounds
+and backend round trips per request.
+
+python -m benchmarks.load --requests 2000 --concurrency 200 --schedulers all_at_once,shared"""
+import argparse
+from functools import partial
+import json
+import sys
+import time
+
+import gevent.pool
+
+from gbatchy import batch_context, pmap, set_default_scheduler, TimeWindowScheduler, SharedScheduler
+from gbatchy.clients.memcached import BatchMemcachedClient
+from gbatchy.clients.redis import BatchRedisClient
+from gbatchy.context import get_context
+from gbatchy.scheduler import AllAtOnceScheduler
+
+from .fakes import FakeMemcached, FakeRedis
+
+SCHEDULERS = {
+    'all_at_once': AllAtOnceScheduler,
+    'time_window': partial(TimeWindowScheduler, max_latency=0.002),
+    'shared': SharedScheduler,
+}
+
+
+class Workload(object):
+    def __init__(self, depth=3, fanout=3, keys_per_level=5, latency=0.001, per_key=0.00001):
+        self.depth = depth
+        self.fanout = fanout
+        self.keys_per_level = keys_per_level
+        self.memcached_backend = FakeMemcached(latency, per_key)
+        self.redis_backend = FakeRedis(latency, per_key)
+        self.memcached = BatchMemcachedClient(self.memcached_backend)
+        self.redis = BatchRedisClient(self.redis_backend)
+
+        # Half the keys exist, so results aren't all empty.
+        for level in xrange(depth):
+            for i in xrange(0, keys_per_level, 2):
+                self.memcached_backend.data['%d:%d' % (level, i)] = i
+                self.redis_backend.data['%d:%d' % (level, i)] = i
+
+    def node(self, level, path):
+        keys = ['%d:%d' % (level, i) for i in xrange(self.keys_per_level)]
+        found = len(self.memcached.get_multi(keys)) + sum(1 for v in pmap(self.redis.get, keys) if v is not None)
+        if level + 1 < self.depth:
+            found += sum(pmap(lambda i: self.node(level + 1, path + (i,)), xrange(self.fanout)))
+        return found
+
+    @batch_context
+    def request(self):
+        found = self.node(0, ())
+        return found, get_context().rounds
+
+    def backend_calls(self):
+        return self.memcached_backend.calls + self.redis_backend.calls
+
+    def reset_counters(self):
+        self.memcached_backend.reset_counters()
+        self.redis_backend.reset_counters()
+
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def simulate(workload, requests=2000, concurrency=200):
+    """Runs `requests` requests, `concurrency` of them at a time, and returns a dict of results."""
+    latencies = []
+    rounds = []
+
+    def timed_request():
+        start = time.time()
+        _, request_rounds = workload.request()
+        latencies.append(time.time() - start)
+        rounds.append(request_rounds)
+
+    workload.reset_counters()
+    pool = gevent.pool.Pool(concurrency)  # A plain gevent pool, so each request gets its own context.
+    start = time.time()
+    for _ in xrange(requests):
+        pool.spawn(timed_request)
+    pool.join()
+    duration = time.time() - start
+
+    latencies.sort()
+    return {
+        'requests_per_sec': requests / duration,
+        'p50_ms': _percentile(latencies, 0.5) * 1e3,
+        'p99_ms': _percentile(latencies, 0.99) * 1e3,
+        'rounds_per_request': float(sum(rounds)) / requests,
+        'backend_calls_per_request': float(workload.backend_calls()) / requests,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--keys-per-level', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.001, help='Seconds per backend round trip.')
+    parser.add_argument('--per-key', type=float, default=0.00001, help='Additional seconds per key in a round trip.')
+    parser.add_argument('--schedulers', default=','.join(sorted(SCHEDULERS)))
+    parser.add_argument('--save', help='Saves the results to this JSON file.')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.schedulers.split(','):
+        set_default_scheduler(SCHEDULERS[name])
+        try:
+            workload = Workload(args.depth, args.fanout, args.keys_per_level, args.latency, args.per_key)
+            results[name] = simulate(workload, args.requests, args.concurrency)
+        finally:
+            set_default_scheduler(AllAtOnceScheduler)
+
+    columns = ['requests_per_sec', 'p50_ms', 'p99_ms', 'rounds_per_request', 'backend_calls_per_request']
+    sys.stdout.write('%-14s' % 'scheduler' + ''.join('%27s' % c for c in columns) + '\n')
+    for name, result in sorted(results.iteritems()):
+        sys.stdout.write('%-14s' % name + ''.join('%27.2f' % result[c] for c in columns) + '\n')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
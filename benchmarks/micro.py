@@ -0,0 +1,171 @@
+"""Microbenchmarks of the hot paths: greenlet creation, queueing batched calls, the future
+helpers, and running batches.
+
+python -m benchmarks.micro [-k name] [--save baseline.json] [--compare baseline.json]"""
+from gbatchy import batched, batch_context, spawn, spawn_many, transform, pget, pmap, immediate, Pool, Raise
+from gbatchy.utils import chain
+from gbatchy.scheduler import AllAtOnceScheduler, SharedScheduler
+
+from . import main, Section
+
+
+def _noop():
+    pass
+
+
+@batched(accepts_kwargs=False)
+def _identity(arg_list):
+    return [args[0] for args in arg_list]
+
+
+@batched(accepts_kwargs=False)
+def _failing(arg_list):
+    return [Raise(ValueError(args[0])) for args in arg_list]
+
+
+@batch_context
+def bench_spawn(n):
+    greenlets = [spawn(_noop) for _ in xrange(n)]
+    for g in greenlets:
+        g.join()
+
+
+@batch_context
+def bench_spawn_many(n):
+    for g in spawn_many(_noop_item, xrange(n)):
+        g.join()
+
+
+def _noop_item(i):
+    pass
+
+
+@batch_context
+def bench_batch_wait(n):
+    greenlets = [spawn(_identity, i) for i in xrange(n)]
+    for g in greenlets:
+        g.get()
+
+
+def bench_batch_wait_top_level(n):
+    for i in xrange(n):
+        _identity(i)
+
+
+@batch_context
+def bench_batch_wait_as_future(n):
+    futures = [_identity(i, as_future=True) for i in xrange(n)]
+    for f in futures:
+        f.get()
+
+
+def _add_one(pending):
+    return pending.get() + 1
+
+
+def bench_transform(n):
+    for i in xrange(n):
+        transform(immediate(i), _add_one).get()
+
+
+def _add_one_later(pending):
+    return immediate(pending.get() + 1)
+
+
+def bench_chain(n):
+    for i in xrange(n):
+        chain(immediate(i), _add_one_later).get()
+
+
+def bench_pget(n):
+    @batch_context
+    def run():
+        greenlets = [spawn(_noop) for _ in xrange(n)]
+        with section:
+            pget(greenlets)
+    section = Section()
+    run()
+    return section
+
+
+def bench_pmap(n):
+    pmap(_identity, xrange(n))
+
+
+@batch_context
+def bench_pool_imap(n):
+    for _ in Pool(100).imap(_identity, xrange(n)):
+        pass
+
+
+def _catch(i):
+    try:
+        _failing(i)
+    except ValueError:
+        return True
+
+
+@batch_context
+def bench_raise(n):
+    greenlets = [spawn(_catch, i) for i in xrange(n)]
+    for g in greenlets:
+        assert g.get()
+
+
+def _run_next(pending, section):
+    @batch_context
+    def run():
+        # Queue everything on a scheduler of our own, so only run_next & the batch itself get measured.
+        scheduler = AllAtOnceScheduler()
+        results = [scheduler.run_pending_batch(id(_identity), _identity.batch_fn, (i,)) for i in xrange(pending)]
+        with section:
+            scheduler.run_next()
+            for r in results:
+                r.get()
+    run()
+
+
+def bench_run_next(pending):
+    def bench(n):
+        # Exactly n calls, in batches of (at most) pending.
+        section = Section()
+        for start in xrange(0, n, pending):
+            _run_next(min(pending, n - start), section)
+        return section
+    return bench
+
+
+def bench_shared(n):
+    @batch_context
+    def run():
+        scheduler = SharedScheduler(max_per_context=n)
+        results = [scheduler.run_pending_batch(id(_identity), _identity.batch_fn, (i,)) for i in xrange(n)]
+        with section:
+            scheduler.run_next()
+            for r in results:
+                r.get()
+    section = Section()
+    run()
+    return section
+
+
+BENCHMARKS = {
+    'spawn': (bench_spawn, 20000),
+    'spawn_many': (bench_spawn_many, 20000),
+    'batch_wait': (bench_batch_wait, 20000),
+    'batch_wait_as_future': (bench_batch_wait_as_future, 20000),
+    'batch_wait_top_level': (bench_batch_wait_top_level, 20000),
+    'transform': (bench_transform, 50000),
+    'chain': (bench_chain, 50000),
+    'pget': (bench_pget, 50000),
+    'pmap': (bench_pmap, 20000),
+    'pool_imap': (bench_pool_imap, 20000),
+    'raise': (bench_raise, 20000),
+    'run_next_10': (bench_run_next(10), 20000),
+    'run_next_1k': (bench_run_next(1000), 20000),
+    'run_next_100k': (bench_run_next(100000), 100000),
+    'shared_100k': (bench_shared, 100000),
+}
+
+if __name__ == '__main__':
+    main(BENCHMARKS)
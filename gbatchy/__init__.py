@@ -2,9 +2,17 @@ from ._version import get_versions
 __version__ = get_versions()['version']
 del get_versions
 
-from .context import batch_context, BatchGreenlet, spawn, add_auto_wrapper, set_default_scheduler
-from .batch import batched, class_batched
-from .scheduler import Raise
+from .context import (batch_context, BatchGreenlet, spawn, spawn_many, add_auto_wrapper, set_default_scheduler, deadline,
+                      time_remaining, DeadlineExceeded, set_hang_threshold)
+from .batch import batched, class_batched, keyed_batched, class_keyed_batched, KeyedResult
+from .breaker import CircuitBreaker, CircuitOpenError
+from .budget import round_budget, RoundBudgetExceeded
+from .cache import LRUCache
+from .retry import RetryPolicy
+from .stats import add_stats_listener, remove_stats_listener, StatsListener, BatchStats
+from .trace import Tracer, tracing
+from .scheduler import (Raise, TimeWindowScheduler, SharedScheduler, AdaptiveBatchSize, adaptive_limits,
+                        cancelled_calls, CallCancelled)
 from .utils import (pmap, pmap_unordered, pfilter, pfilter_unordered, pget, immediate,
                     immediate_exception, transform, spawn_proxy, iwait, wait, Pool)
 
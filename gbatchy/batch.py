@@ -1,50 +1,361 @@
+from collections import Mapping
 from functools import wraps, partial
+import inspect
+import sys
+import time
 
-from .context import get_context, batch_context
+from gevent import getcurrent
 
-@batch_context
-def _batch_wait(fn_id, fn, args, dec_kwargs, as_future=False):
-    future = get_context().scheduler.run_pending_batch(fn_id, fn, args, **dec_kwargs)
-    return future if as_future else future.get()
+from .breaker import _FallbackResult
+from .cache import _MISSING
+from .context import get_context, spawn, BatchAsyncResult, DeadlineExceeded
+from .scheduler import Scheduler, _args_key, _unwrap
+from .utils import immediate, immediate_exception, _BATCHED_FUNCTIONS
 
+def _batch_wait(fn_id, fn, args, dec_kwargs, as_future=False, batch_timeout=None):
+    context = get_context()
+    if context is None:
+        if batch_timeout is None:
+            return _run_inline(fn_id, fn, args, dec_kwargs, as_future)
+        return spawn(_batch_wait, fn_id, fn, args, dec_kwargs, as_future, batch_timeout).get()
+
+    deadline = getcurrent().deadline if batch_timeout is None else _get_deadline(batch_timeout)
+    if deadline is None:
+        future = context.scheduler.run_pending_batch(fn_id, fn, args, **dec_kwargs)
+        return future if as_future else future.get()
+
+    future = context.scheduler.run_pending_batch(fn_id, fn, args, deadline=deadline, **dec_kwargs)
+    return future if as_future else _get_before(future, deadline)
+
+
+_INLINE_SCHEDULER = Scheduler()
+
+def _run_inline(fn_id, fn, args, dec_kwargs, as_future=False):
+    """Runs a call made outside of any batch context right away, as a batch of one. There is
+    nothing to batch it with, so this skips creating a greenlet, a context and a scheduler."""
+    breaker = dec_kwargs.get('breaker')
+    if breaker is not None:
+        breaker = breaker.circuit(fn_id, fn)
+        if not breaker.allow():
+            future = breaker.reject()
+            return future if as_future else future.get()
+
+    stream = dec_kwargs.get('stream')
+    futures = [BatchAsyncResult()] if stream is not None else None
+    results = _INLINE_SCHEDULER.run_batch(
+        fn, [args], futures, stream=stream, chunk_size=dec_kwargs.get('chunk_size'),
+        adaptive=dec_kwargs.get('adaptive'), executor=dec_kwargs.get('executor'),
+        retry=dec_kwargs.get('retry'), breaker=breaker)
+
+    if as_future:
+        if futures is not None:
+            return futures[0]
+        try:
+            return immediate(_unwrap(results[0]))
+        except Exception as ex:
+            return immediate_exception(ex, sys.exc_info())
+
+    return futures[0].get() if futures is not None else _unwrap(results[0])
+
+
+def _get_deadline(batch_timeout):
+    deadline = getcurrent().deadline
+    if batch_timeout is not None:
+        call_deadline = time.time() + batch_timeout
+        if deadline is None or call_deadline < deadline:
+            deadline = call_deadline
+    return deadline
+
+
+def _run_pending_batch(context, fn_id, fn, args, dec_kwargs, deadline):
+    if deadline is None:
+        return context.scheduler.run_pending_batch(fn_id, fn, args, **dec_kwargs)
+    return context.scheduler.run_pending_batch(fn_id, fn, args, deadline=deadline, **dec_kwargs)
+
+
+def _get_before(future, deadline):
+    if deadline is not None:
+        future.wait(timeout=max(0.0, deadline - time.time()))
+        if not future.ready():
+            raise DeadlineExceeded('Deadline exceeded while waiting for a batch.')
+    return future.get()
+
+
+def _context_cached_batch_wait(fn_id, fn, args, dec_kwargs, as_future=False, batch_timeout=None):
+    key = _args_key(args) if get_context() is not None else None
+    if key is None:
+        return _batch_wait(fn_id, fn, args, dec_kwargs, as_future=as_future, batch_timeout=batch_timeout)
+
+    cache = _get_context_cache(fn_id, create=True)
+    future = cache.get(key)
+    if future is not None and future.ready():
+        if future.successful():
+            return immediate(future.value) if as_future else future.value
+        future = None  # Don't cache failures.
+
+    context = get_context()
+    deadline = _get_deadline(batch_timeout)
+    if future is None:
+        future = _run_pending_batch(context, fn_id, fn, args, dec_kwargs, deadline)
+        if deadline is None:
+            # A call with a deadline may be dropped from its batch, so other callers can't share it.
+            cache[key] = future
+    return future if as_future else _get_before(future, deadline)
+
+
+def _shared_cached_batch_wait(cache, fn_id, fn, args, dec_kwargs, as_future=False, batch_timeout=None,
+                              cache_id=None):
+    key = _args_key(args)
+    if key is None:
+        return _batch_wait(fn_id, fn, args, dec_kwargs, as_future=as_future, batch_timeout=batch_timeout)
+
+    key = (fn_id if cache_id is None else cache_id, key)
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return immediate(value) if as_future else value
+
+    return _shared_cache_miss(cache, key, fn_id, fn, args, dec_kwargs, as_future, batch_timeout)
+
+
+def _shared_cache_miss(cache, key, fn_id, fn, args, dec_kwargs, as_future, batch_timeout):
+    context = get_context()
+    if context is None:
+        if batch_timeout is None:
+            future = _run_inline(fn_id, fn, args, dec_kwargs, as_future=True)
+            _store_result(cache, key, future)
+            return future if as_future else future.get()
+        return spawn(_shared_cache_miss, cache, key, fn_id, fn, args, dec_kwargs, as_future, batch_timeout).get()
+
+    deadline = _get_deadline(batch_timeout)
+    future = _run_pending_batch(context, fn_id, fn, args, dec_kwargs, deadline)
+    future.rawlink(partial(_store_result, cache, key))
+    return future if as_future else _get_before(future, deadline)
+
+
+def _instance_cached_batch_wait(cache, cache_key, fn_id, fn, args, dec_kwargs, as_future=False, batch_timeout=None):
+    """_shared_cached_batch_wait for @class_batched: entries are keyed on cache_key(instance) rather than on
+    the id() of the instance (fn is partial(method, instance)), which gets reused once it's garbage collected."""
+    return _shared_cached_batch_wait(cache, fn_id, fn, args, dec_kwargs, as_future, batch_timeout,
+                                     cache_id=(fn_id[0], cache_key(fn.args[0])))
+
+
+def _store_result(cache, key, future):
+    if future.successful() and not isinstance(future, _FallbackResult):
+        cache.set(key, future.value)
+
+
+def _get_context_cache(fn_id, create=False):
+    """Returns the {args key: future} cache of fn_id in the current context."""
+    context = get_context()
+    if context is None:
+        return None
+
+    if context.batch_cache is None:
+        if not create:
+            return None
+        context.batch_cache = {}
+
+    cache = context.batch_cache.get(fn_id)
+    if cache is None and create:
+        cache = context.batch_cache[fn_id] = {}
+    return cache
+
+
+def _prime(fn_id, args, value):
+    key = _args_key(args)
+    cache = _get_context_cache(fn_id, create=True)
+    if key is not None and cache is not None:
+        cache[key] = immediate(value)
+
+
+def _clear(fn_id, args):
+    cache = _get_context_cache(fn_id)
+    if cache is not None:
+        cache.pop(_args_key(args), None)
+
+
+def _clear_all(fn_id):
+    context = get_context()
+    if context is not None and context.batch_cache is not None:
+        context.batch_cache.pop(fn_id, None)
+
+
+def _get_batch_wait(cache):
+    if cache is None:
+        return _batch_wait
+    elif cache == 'context':
+        return _context_cached_batch_wait
+    elif hasattr(cache, 'get') and hasattr(cache, 'set'):
+        return partial(_shared_cached_batch_wait, cache)
+    else:
+        raise ValueError('Unknown cache type: %r' % (cache,))
+
+
+def _with_stream(fn, dec_kwargs):
+    """Generator functions stream their results (see Scheduler.run_streaming_batch_fn)."""
+    if 'stream' not in dec_kwargs and inspect.isgeneratorfunction(fn):
+        return dict(dec_kwargs, stream='ordered')
+    return dec_kwargs
+
+
+def batched(accepts_kwargs=True, cache=None, **dec_kwargs):
+    """Marks fn as a batch function. See the README for the available options. The undecorated
+    function is available as .batch_fn.
+
+    With cache='context', results are memoized for the lifetime of the current batch context. The
+    returned function then also has prime(value, *args, **kwargs), clear(*args, **kwargs) and
+    clear_all() to manage the cache of the current context.
+
+    cache can also be an LRUCache (or anything with get(key, default) and set(key, value)), which is
+    checked before queueing a call and filled in as batches complete."""
+    batch_wait = _get_batch_wait(cache)
 
-def batched(accepts_kwargs=True, **dec_kwargs):
     def wrapper(fn):
-        global _batch_wait
         fn_id = id(fn)
+        fn_kwargs = _with_stream(fn, dec_kwargs)
 
         @wraps(fn)
         def wrap_kwargs(*args, **kwargs):
-            return _batch_wait(fn_id, fn, (args, kwargs), dec_kwargs,
-                               as_future=kwargs.pop('as_future', False))
+            return batch_wait(fn_id, fn, (args, kwargs), fn_kwargs,
+                              as_future=kwargs.pop('as_future', False),
+                              batch_timeout=kwargs.pop('batch_timeout', None))
 
         @wraps(fn)
         def wrap_no_kwargs(*args, **kwargs):
-            return _batch_wait(fn_id, fn, args, dec_kwargs, **kwargs)
+            return batch_wait(fn_id, fn, args, fn_kwargs, **kwargs)
 
-        return wrap_kwargs if accepts_kwargs else wrap_no_kwargs
+        result = wrap_kwargs if accepts_kwargs else wrap_no_kwargs
+        result.batch_fn = fn
+        _BATCHED_FUNCTIONS.add(result)
+        if cache == 'context':
+            result.prime = lambda value, *args, **kwargs: _prime(fn_id, (args, kwargs) if accepts_kwargs else args, value)
+            result.clear = lambda *args, **kwargs: _clear(fn_id, (args, kwargs) if accepts_kwargs else args)
+            result.clear_all = lambda: _clear_all(fn_id)
+        return result
     return wrapper
 
-def class_batched(accepts_kwargs=True, **dec_kwargs):
+def class_batched(accepts_kwargs=True, cache=None, cache_key=None, **dec_kwargs):
+    """Same as batched(), but for methods. Each instance gets its own batches.
+
+    With cache='context', prime/clear/clear_all take the instance as their first argument, e.g.
+    Client.get.prime(client, value, key).
+
+    A process-wide cache (e.g. an LRUCache) outlives instances, so it also needs cache_key: a
+    function that returns a stable, hashable key for an instance (e.g. lambda self: self.name).
+    Instances with the same key share cache entries."""
+    batch_wait = _get_batch_wait(cache)
+    if cache is not None and cache != 'context':
+        if cache_key is None:
+            raise ValueError('class_batched(cache=%r) needs cache_key= to tell instances apart.' % (cache,))
+        batch_wait = partial(_instance_cached_batch_wait, cache, cache_key)
+
     def wrapper(fn):
-        global _batch_wait
         fn_id = id(fn)
+        fn_kwargs = _with_stream(fn, dec_kwargs)
 
         @wraps(fn)
         def wrap_kwargs(self, *args, **kwargs):
-            return _batch_wait((fn_id, id(self)),
-                               partial(fn, self),
-                               (args, kwargs),
-                               dec_kwargs,
-                               as_future=kwargs.pop('as_future', False))
+            return batch_wait((fn_id, id(self)),
+                              partial(fn, self),
+                              (args, kwargs),
+                              fn_kwargs,
+                              as_future=kwargs.pop('as_future', False),
+                              batch_timeout=kwargs.pop('batch_timeout', None))
 
         @wraps(fn)
         def wrap_no_kwargs(self, *args, **kwargs):
-            return _batch_wait((fn_id, id(self)),
-                               partial(fn, self),
-                               args,
-                               dec_kwargs,
-                               **kwargs)
+            return batch_wait((fn_id, id(self)),
+                              partial(fn, self),
+                              args,
+                              fn_kwargs,
+                              **kwargs)
+
+        result = wrap_kwargs if accepts_kwargs else wrap_no_kwargs
+        result.batch_fn = fn
+        _BATCHED_FUNCTIONS.add(result)
+        if cache == 'context':
+            result.prime = lambda self, value, *args, **kwargs: _prime(
+                (fn_id, id(self)), (args, kwargs) if accepts_kwargs else args, value)
+            result.clear = lambda self, *args, **kwargs: _clear(
+                (fn_id, id(self)), (args, kwargs) if accepts_kwargs else args)
+            result.clear_all = lambda self: _clear_all((fn_id, id(self)))
+        return result
+    return wrapper
+
+
+class KeyedResult(Mapping):
+    """The result of a @keyed_batched call: a read-only view of the mapping returned by the batch
+    function, restricted to the keys that the call asked for. Keys missing from the mapping are
+    missing here too."""
+    __slots__ = ['_data', '_keys']
+
+    def __init__(self, data, keys):
+        self._data = data
+        self._keys = keys
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._keys and key in self._data
 
-        return wrap_kwargs if accepts_kwargs else wrap_no_kwargs
+    def __iter__(self):
+        data = self._data
+        return (k for k in self._keys if k in data)
+
+    def __len__(self):
+        data = self._data
+        return sum(1 for k in self._keys if k in data)
+
+    def __repr__(self):
+        return 'KeyedResult(%r)' % (dict(self.iteritems()),)
+
+
+def _as_key_set(keys):
+    return keys if isinstance(keys, (frozenset, set)) else frozenset(keys)
+
+
+def _run_keyed(fn, arg_list):
+    results = fn(frozenset().union(*[args[0] for args in arg_list]))
+    if results is None:
+        results = {}
+    return [KeyedResult(results, args[0]) for args in arg_list]
+
+
+def keyed_batched(**dec_kwargs):
+    """Marks fn as a batch function that looks up keys: each call passes an iterable of keys, fn gets
+    called with the (deduplicated) set of all of the keys in the batch and returns a single
+    {key: value} mapping. Each call gets a KeyedResult with just the keys it asked for.
+
+    Takes the same options as @batched()."""
+    def wrapper(fn):
+        @wraps(fn)
+        def run(arg_list):
+            return _run_keyed(fn, arg_list)
+        batch = batched(accepts_kwargs=False, **dec_kwargs)(run)
+
+        @wraps(fn)
+        def call(keys, as_future=False, batch_timeout=None):
+            return batch(_as_key_set(keys), as_future=as_future, batch_timeout=batch_timeout)
+        call.batch_fn = batch.batch_fn
+        _BATCHED_FUNCTIONS.add(call)
+        return call
+    return wrapper
+
+def class_keyed_batched(**dec_kwargs):
+    """Same as keyed_batched(), but for methods."""
+    def wrapper(fn):
+        @wraps(fn)
+        def run(self, arg_list):
+            return _run_keyed(partial(fn, self), arg_list)
+        batch = class_batched(accepts_kwargs=False, **dec_kwargs)(run)
+
+        @wraps(fn)
+        def call(self, keys, as_future=False, batch_timeout=None):
+            return batch(self, _as_key_set(keys), as_future=as_future, batch_timeout=batch_timeout)
+        call.batch_fn = batch.batch_fn
+        _BATCHED_FUNCTIONS.add(call)
+        return call
     return wrapper
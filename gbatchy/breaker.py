@@ -0,0 +1,131 @@
+from collections import deque
+import time
+
+from .utils import immediate_exception, _ImmediateResult
+
+class CircuitOpenError(Exception):
+    """Raised by calls to a batch function while its circuit breaker is open."""
+
+
+_NO_FALLBACK = object()
+
+class _FallbackResult(_ImmediateResult):
+    """The fallback value of a rejected call. It doesn't come from the batch function, so caches skip it."""
+    __slots__ = ()
+
+class CircuitBreaker(object):
+    """Stops calling a failing or slow backend, for use as @batched(breaker=CircuitBreaker(...)).
+
+    Every batch function gets its own circuit. For @class_batched methods, all instances share the
+    method's circuit, unless instance_key is given: a function that returns a stable, hashable key
+    for an instance (e.g. lambda self: self.host), in which case each key gets its own circuit. Like
+    LRUCache's cache_key, this doesn't use id(instance), which gets reused once it's garbage
+    collected. The circuits are:
+     - closed: batches run normally. Once at least min_batches of the last `window` batches ran and
+       at least error_rate of them failed (raised, or took longer than max_latency), it opens.
+     - open: calls fail right away with CircuitOpenError (or return `fallback`, if given) without
+       being queued. After reset_timeout seconds, the next batch is let through as a probe.
+     - half-open: the probe is running; other calls still fail fast. If the probe succeeds the
+       circuit closes, otherwise it opens again. If the probe never runs (all of its calls were
+       dropped) the next batch becomes the probe, and so does the first batch after reset_timeout
+       if the probe never finishes (e.g. its greenlet was killed).
+
+    states() returns the state of every circuit, e.g. for health checks."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, error_rate=0.5, window=20, min_batches=5, max_latency=None, reset_timeout=5,
+                 fallback=_NO_FALLBACK, instance_key=None):
+        self.error_rate = error_rate
+        self.window = window
+        self.min_batches = min_batches
+        self.max_latency = max_latency
+        self.reset_timeout = reset_timeout
+        self.fallback = fallback
+        self.instance_key = instance_key
+        self.circuits = {}  # {function id, or (method id, instance_key(instance)): _Circuit}
+
+    def circuit(self, id_, function):
+        key = None
+        if type(id_) is tuple:  # @class_batched: (method id, instance id) & partial(method, instance)
+            if self.instance_key is None:
+                id_ = id_[0]
+            else:
+                key = self.instance_key(function.args[0])
+                id_ = (id_[0], key)
+        circuit = self.circuits.get(id_)
+        if circuit is None:
+            circuit = self.circuits[id_] = _Circuit(self, _circuit_name(function, key))
+        return circuit
+
+    def states(self):
+        """Returns {function name: state} for every circuit."""
+        return {circuit.name: circuit.state for circuit in self.circuits.itervalues()}
+
+
+def _circuit_name(function, key=None):
+    instance = getattr(function, 'args', None)
+    fn = getattr(function, 'func', function)  # class_batched uses functools.partial
+    name = getattr(fn, '__name__', None) or repr(fn)
+    if instance:
+        name = '%s.%s' % (type(instance[0]).__name__, name)
+        if key is not None:
+            name = '%s[%r]' % (name, key)
+    return name
+
+
+class _Circuit(object):
+    __slots__ = ['breaker', 'name', 'state', 'outcomes', 'opened_at']
+
+    def __init__(self, breaker, name):
+        self.breaker = breaker
+        self.name = name
+        self.state = CircuitBreaker.CLOSED
+        self.outcomes = deque(maxlen=breaker.window)  # True for every failed batch.
+        self.opened_at = None  # When the circuit opened, or when the probe was let through.
+
+    def allow(self):
+        """Returns whether a new batch may be started."""
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        elif time.time() >= self.opened_at + self.breaker.reset_timeout:
+            # Open for long enough, or the probe is taking so long it probably won't ever record().
+            self.state = CircuitBreaker.HALF_OPEN
+            self.opened_at = time.time()
+            return True
+        return False
+
+    def release(self):
+        """Called instead of record() for a batch that was allowed but didn't run at all."""
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = time.time() - self.breaker.reset_timeout  # The next batch is the probe.
+
+    def reject(self):
+        if self.breaker.fallback is not _NO_FALLBACK:
+            return _FallbackResult(self.breaker.fallback)
+        return immediate_exception(CircuitOpenError('Circuit breaker for %s is %s' % (self.name, self.state)))
+
+    def record(self, failed, duration):
+        breaker = self.breaker
+        if breaker.max_latency is not None and duration > breaker.max_latency:
+            failed = True
+
+        if self.state == CircuitBreaker.HALF_OPEN:
+            if failed:
+                self._open()
+            else:
+                self.state = CircuitBreaker.CLOSED
+                self.outcomes.clear()
+        elif self.state == CircuitBreaker.CLOSED:
+            outcomes = self.outcomes
+            outcomes.append(failed)
+            if len(outcomes) >= breaker.min_batches and sum(outcomes) >= breaker.error_rate * len(outcomes):
+                self._open()
+
+    def _open(self):
+        self.state = CircuitBreaker.OPEN
+        self.opened_at = time.time()
+        self.outcomes.clear()
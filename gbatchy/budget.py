@@ -0,0 +1,142 @@
+from functools import wraps
+from gevent import getcurrent
+import logging
+import random
+import sys
+
+from .context import batch_context, get_context
+from .stats import StatsListener, add_stats_listener, remove_stats_listener
+
+logger = logging.getLogger(__name__)
+
+
+class RoundBudgetExceeded(Exception):
+    pass
+
+
+class round_budget(object):
+    """Checks how many rounds of batches run in the current batch context while in the with block
+    (or the decorated function, which gets its own batch context). This catches changes that
+    turn one round of batches into many sequential ones.
+
+     - max_rounds: the maximum number of scheduler rounds.
+     - max_batches_per_fn: the maximum number of batches of any single batched function.
+     - max_single_batches: the maximum number of batches of size 1 of any single batched function,
+       the usual sign of an N+1 pattern (e.g. calling a batched function in a loop).
+     - action: 'raise' (RoundBudgetExceeded, e.g. in tests) or 'log' (a warning with the call site).
+     - sample_rate: the fraction of with blocks/calls that get checked at all.
+
+    Batch counts are only available for AllAtOnceScheduler/TimeWindowScheduler."""
+
+    def __init__(self, max_rounds=None, max_batches_per_fn=None, max_single_batches=3, action='raise',
+                 sample_rate=1.0):
+        assert action in ('raise', 'log')
+        self.max_rounds = max_rounds
+        self.max_batches_per_fn = max_batches_per_fn
+        self.max_single_batches = max_single_batches
+        self.action = action
+        self.sample_rate = sample_rate
+        self._active = {}  # {greenlet: [_BudgetScope]}
+
+    def __enter__(self):
+        frame = sys._getframe(1)
+        self._enter(lambda: '%s:%d' % (frame.f_code.co_filename, frame.f_lineno))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        scope = self._active[getcurrent()].pop()
+        if not self._active[getcurrent()]:
+            del self._active[getcurrent()]
+        if scope is not None:
+            scope.close(self, check=exc_type is None)
+
+    def _enter(self, call_site):
+        scope = None
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            context = get_context()
+            if context is None:
+                raise RuntimeError('round_budget() needs to be used in a batch context.')
+            scope = _BudgetScope(context, call_site())
+        self._active.setdefault(getcurrent(), []).append(scope)
+
+    def __call__(self, fn):
+        code = fn.__code__
+        call_site = lambda: '%s (%s:%d)' % (fn.__name__, code.co_filename, code.co_firstlineno)
+
+        @wraps(fn)
+        @batch_context
+        def wrapper(*args, **kwargs):
+            self._enter(call_site)
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                self.__exit__(*sys.exc_info())
+                raise
+            self.__exit__(None, None, None)
+            return result
+        return wrapper
+
+    def violations(self, rounds, batches, single_batches):
+        violations = []
+        if self.max_rounds is not None and rounds > self.max_rounds:
+            violations.append('%d rounds (max %d)' % (rounds, self.max_rounds))
+        for name, count in sorted(batches.iteritems()):
+            if self.max_batches_per_fn is not None and count > self.max_batches_per_fn:
+                violations.append('%d batches of %s (max %d)' % (count, name, self.max_batches_per_fn))
+        for name, count in sorted(single_batches.iteritems()):
+            if self.max_single_batches is not None and count > self.max_single_batches:
+                violations.append('%d batches of size 1 of %s, probably an N+1 pattern' % (count, name))
+        return violations
+
+
+class _BudgetScope(object):
+    __slots__ = ['context', 'call_site', 'start_rounds', 'batches', 'single_batches']
+
+    def __init__(self, context, call_site):
+        self.context = context
+        self.call_site = call_site
+        self.start_rounds = context.rounds
+        self.batches = {}  # {name: count}
+        self.single_batches = {}  # {name: count}
+        _LISTENER.add(self)
+
+    def close(self, budget, check=True):
+        _LISTENER.remove(self)
+        if not check:
+            return
+
+        violations = budget.violations(self.context.rounds - self.start_rounds, self.batches, self.single_batches)
+        if violations:
+            message = 'Round budget exceeded at %s: %s' % (self.call_site, ', '.join(violations))
+            if budget.action == 'raise':
+                raise RoundBudgetExceeded(message)
+            logger.warning(message)
+
+
+class _BudgetListener(StatsListener):
+    """Counts the batches flushed in each context that has a _BudgetScope open. It's only
+    registered as a stats listener while there are any."""
+
+    def __init__(self):
+        self.scopes = {}  # {id(context): [_BudgetScope]}
+
+    def add(self, scope):
+        if not self.scopes:
+            add_stats_listener(self)
+        self.scopes.setdefault(id(scope.context), []).append(scope)
+
+    def remove(self, scope):
+        scopes = self.scopes[id(scope.context)]
+        scopes.remove(scope)
+        if not scopes:
+            del self.scopes[id(scope.context)]
+            if not self.scopes:
+                remove_stats_listener(self)
+
+    def batch_flushed(self, context, name, size, queued, reason):
+        for scope in self.scopes.get(id(context), ()):
+            scope.batches[name] = scope.batches.get(name, 0) + 1
+            if size == 1:
+                scope.single_batches[name] = scope.single_batches.get(name, 0) + 1
+
+_LISTENER = _BudgetListener()
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+import time
+
+_MISSING = object()
+
+class LRUCache(object):
+    """A bounded, process-wide result cache for @batched(cache=LRUCache(...)) functions.
+
+     - maxsize: the maximum number of entries; the least recently used entry is evicted first.
+     - ttl: how long (in seconds) entries stay valid, or None to keep them until evicted.
+     - cache_none: whether None results get cached (i.e. negative caching).
+
+    hits & misses count the lookups made through get()."""
+
+    __slots__ = ['maxsize', 'ttl', 'cache_none', 'hits', 'misses', '_data']
+
+    def __init__(self, maxsize=1024, ttl=None, cache_none=False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache_none = cache_none
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # {key: (value, expires_at)}, least recently used first.
+
+    def get(self, key, default=None):
+        data = self._data
+        entry = data.pop(key, _MISSING)
+        if entry is _MISSING or (entry[1] is not None and entry[1] < time.time()):
+            self.misses += 1
+            return default
+
+        data[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        if value is None and not self.cache_none:
+            return
+
+        data = self._data
+        data.pop(key, None)
+        data[key] = (value, time.time() + self.ttl if self.ttl is not None else None)
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key, _MISSING)
+        return entry is not _MISSING and (entry[1] is None or entry[1] >= time.time())
@@ -1,12 +1,15 @@
 from collections import defaultdict
 from itertools import chain
 
-from ..batch import class_batched
+from ..batch import class_batched, class_keyed_batched
 from ..utils import transform
 
 def _get_first_future_value(d):
     return next(d.get().itervalues(), None)
 
+def _as_dict(d):
+    return dict(d.get())
+
 class BatchMemcachedClient(object):
     __slots__ = ('client',)
 
@@ -15,23 +18,21 @@ class BatchMemcachedClient(object):
 
     def get(self, key, as_future=False):
         if as_future:
-            return transform(self.get_multi([key], as_future=True),
+            return transform(self._get_multi([key], as_future=True),
                              _get_first_future_value)
         else:
-            return next(self.get_multi([key]).itervalues(), None)
-
-    @class_batched(accepts_kwargs=False)
-    def get_multi(self, keys_lists):
-        """get_multi(iterable_of_keys, key_prefix=b'')"""
-        saved_key_lists = []
-        for args in keys_lists:
-            assert len(args) == 1, 'get_multi only accepts a single argument: ' + args
+            return next(self._get_multi([key]).itervalues(), None)
 
-            saved_key_lists.append(args[0])
+    def get_multi(self, keys, as_future=False):
+        """get_multi(iterable_of_keys) -> {key: value} for the keys that were found."""
+        if as_future:
+            return transform(self._get_multi(keys, as_future=True), _as_dict)
+        else:
+            return dict(self._get_multi(keys))
 
-        results = self.client.get_multi(frozenset(chain.from_iterable(saved_key_lists)))
-        return [{k: results[k] for k in lst if k in results}
-                for lst in saved_key_lists]
+    @class_keyed_batched()
+    def _get_multi(self, keys):
+        return self.client.get_multi(keys)
 
     def set(self, key, value, time=0, as_future=False):
         if as_future:
@@ -4,6 +4,10 @@ from functools import wraps
 from gevent import Greenlet as _GeventGreenlet, getcurrent, Timeout, get_hub, iwait as _gevent_iwait
 import logging
 import sys
+import time
+import traceback
+
+from . import stats
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +16,34 @@ def set_default_scheduler(cls):
     global DEFAULT_SCHEDULER
     DEFAULT_SCHEDULER = cls
 
+HANG_THRESHOLD = None
+def set_hang_threshold(seconds):
+    """Logs the stacks of the greenlets of any batch context that stays blocked for more than
+    `seconds` without any pending or running batches (i.e. every greenlet is waiting on something
+    the scheduler can't make progress on). None turns this off. Only contexts created after this
+    is set are watched."""
+    global HANG_THRESHOLD
+    HANG_THRESHOLD = seconds
+
+def _report_hang(context, greenlets, threshold):
+    lines = ['Batch context %r has been blocked for %.3fs with no pending batches. Its greenlets:' % (
+        context, threshold)]
+    for g in greenlets:
+        frame = g.gr_frame
+        lines.append('%r waiting on %s' % (g, _waited_on(frame)))
+        lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+    logger.warning('\n'.join(lines))
+
+def _waited_on(frame):
+    """Returns the repr of the innermost gevent/gbatchy object the stack is waiting on."""
+    while frame is not None:
+        obj = frame.f_locals.get('self')
+        if (obj is not None and obj is not get_hub() and
+                type(obj).__module__.split('.')[0] in ('gevent', 'gbatchy')):
+            return repr(obj)
+        frame = frame.f_back
+    return 'unknown'
+
 class _DebugContext(object):
     """A version of the context that keeps the actual greenlets around instead
     of just counting how many are runnable."""
@@ -20,14 +52,22 @@ class _DebugContext(object):
         self.greenlets = set()
         self.blocked_greenlets = set()
         self.scheduler = (scheduler_class or DEFAULT_SCHEDULER)()
+        self.batch_cache = None
+        self.rounds = 0
+        self.started = time.time() if stats.LISTENERS else None
 
         self._scheduled_callback = None
+        self._watchdog = None
 
     def greenlet_created(self, g):
         assert g not in self.greenlets
         self.greenlets.add(g)
         self.blocked_greenlets.add(g)
 
+    def greenlets_created(self, greenlets):
+        for g in greenlets:
+            self.greenlet_created(g)
+
     def greenlet_blocked(self, g):
         assert g in self.greenlets
         assert g not in self.blocked_greenlets
@@ -43,6 +83,8 @@ class _DebugContext(object):
         assert g not in self.blocked_greenlets
         self.greenlets.remove(g)
         self.schedule_to_run()
+        if stats.LISTENERS:
+            stats.notify('greenlet_finished', g)
 
     def _maybe_run_scheduler(self):
         self._scheduled_callback = None
@@ -52,10 +94,26 @@ class _DebugContext(object):
             self.greenlets = None
             self.blocked_greenlets = None
             self.scheduler = None
+            self.batch_cache = None
+            if self._watchdog is not None:
+                self._watchdog.stop()
+            if self.started is not None and stats.LISTENERS:
+                stats.notify('context_finished', self, self.rounds, time.time() - self.started)
             return
 
-        if len(self.blocked_greenlets) == len(self.greenlets) and self.scheduler.has_work():
-            self.scheduler.run_next()
+        if len(self.blocked_greenlets) == len(self.greenlets):
+            if self.scheduler.has_work():
+                self.rounds += 1
+                if stats.LISTENERS:
+                    stats.notify('round_started', self)
+                self.scheduler.run_next()
+            elif HANG_THRESHOLD is not None and not getattr(self.scheduler, 'running', 0):
+                self._watchdog = _arm_watchdog(self, self._watchdog)
+
+    def _check_hang(self, threshold):
+        if (self.greenlets and len(self.blocked_greenlets) == len(self.greenlets) and
+                not self.scheduler.has_work() and not getattr(self.scheduler, 'running', 0)):
+            _report_hang(self, list(self.greenlets), threshold)
 
     def schedule_to_run(self):
         if self._scheduled_callback:
@@ -64,19 +122,33 @@ class _DebugContext(object):
 
 
 class _Context(object):
-    __slots__ = ['hub', 'num_greenlets', 'num_blocked', 'scheduler', '_scheduled_callback']
+    __slots__ = ['hub', 'num_greenlets', 'num_blocked', 'greenlets', 'scheduler', 'batch_cache', 'rounds',
+                 'started', '_scheduled_callback', '_watchdog']
 
     def __init__(self, scheduler_class=None):
         self.hub = get_hub()
         self.num_greenlets = 0
         self.num_blocked = 0
+        self.greenlets = set() if HANG_THRESHOLD is not None else None  # Only kept for hang reports.
+        self.batch_cache = None  # {fn_id: {args key: future}} for @batched(cache='context') functions.
+        self.rounds = 0  # How many times the scheduler ran.
+        self.started = time.time() if stats.LISTENERS else None
         self._scheduled_callback = None
+        self._watchdog = None  # A hub timer, see set_hang_threshold.
 
         self.scheduler = (scheduler_class or DEFAULT_SCHEDULER)()
 
     def greenlet_created(self, g):
         self.num_greenlets += 1
         self.num_blocked += 1
+        if self.greenlets is not None:
+            self.greenlets.add(g)
+
+    def greenlets_created(self, greenlets):
+        self.num_greenlets += len(greenlets)
+        self.num_blocked += len(greenlets)
+        if self.greenlets is not None:
+            self.greenlets.update(greenlets)
 
     def greenlet_blocked(self, g):
         self.num_blocked += 1
@@ -89,10 +161,15 @@ class _Context(object):
 
     def greenlet_finished(self, g):
         self.num_greenlets -= 1
+        if self.greenlets is not None:
+            self.greenlets.discard(g)
 
         if not self._scheduled_callback and self.num_blocked == self.num_greenlets:
             self._scheduled_callback = self.hub.loop.run_callback(self._maybe_run_scheduler)
 
+        if stats.LISTENERS:
+            stats.notify('greenlet_finished', g)
+
     def _maybe_run_scheduler(self):
         self._scheduled_callback = None
 
@@ -100,22 +177,85 @@ class _Context(object):
             # Reset to stop refcycles as well as break anyone who is doing something bad.
             self.num_greenlets = None
             self.num_blocked = None
+            self.greenlets = None
             self.scheduler = None
+            self.batch_cache = None
+            if self._watchdog is not None:
+                self._watchdog.stop()
+            if self.started is not None and stats.LISTENERS:
+                stats.notify('context_finished', self, self.rounds, time.time() - self.started)
             return
 
-        if self.num_greenlets == self.num_blocked and self.scheduler.has_work():
-            self.scheduler.run_next()
+        if self.num_greenlets == self.num_blocked:
+            if self.scheduler.has_work():
+                self.rounds += 1
+                if stats.LISTENERS:
+                    stats.notify('round_started', self)
+                self.scheduler.run_next()
+            elif (HANG_THRESHOLD is not None and self.greenlets is not None and
+                    not getattr(self.scheduler, 'running', 0)):
+                self._watchdog = _arm_watchdog(self, self._watchdog)
+
+    def _check_hang(self, threshold):
+        if (self.num_greenlets and self.num_greenlets == self.num_blocked and not self.scheduler.has_work() and
+                not getattr(self.scheduler, 'running', 0)):
+            _report_hang(self, list(self.greenlets), threshold)
 
     def schedule_to_run(self):
         if not self._scheduled_callback:
             self._scheduled_callback = self.hub.loop.run_callback(self._maybe_run_scheduler)
 
 
+def _arm_watchdog(context, timer):
+    """(Re)starts the hang detection timer of context. Any progress makes the context call this
+    again, which pushes the check back."""
+    if timer is None:
+        timer = context.hub.loop.timer(HANG_THRESHOLD)
+    else:
+        timer.stop()
+    timer.start(context._check_hang, HANG_THRESHOLD)
+    return timer
+
+
 CONTEXT_FACTORY = _Context
 def get_context():
     return getattr(getcurrent(), 'context', None)
 
 
+class DeadlineExceeded(Exception):
+    """Raised by batched calls that didn't finish before their deadline."""
+
+
+@contextmanager
+def deadline(seconds):
+    """Gives every batched call made by the current greenlet at most `seconds` to finish (or less, if
+    there already is a tighter deadline). Calls whose deadline passes before their batch starts are
+    dropped from it. Greenlets spawned in the with block get the same deadline."""
+    current = getcurrent()
+    if getattr(current, 'context', None) is None:
+        raise RuntimeError('deadline() needs to be used in a batch context.')
+
+    previous = current.deadline
+    new_deadline = time.time() + seconds
+    if previous is None or new_deadline < previous:
+        current.deadline = new_deadline
+    try:
+        yield
+    finally:
+        current.deadline = previous
+
+
+def time_remaining():
+    """Returns how many seconds are left before the current deadline, or None if there is none.
+
+    In a batch function, this is the tightest deadline of the calls in the batch, e.g. for use as
+    a socket timeout."""
+    current_deadline = getattr(getcurrent(), 'deadline', None)
+    if current_deadline is None:
+        return None
+    return max(0.0, current_deadline - time.time())
+
+
 AUTO_WRAPPERS = []
 def add_auto_wrapper(fn):
     """Adds decorator fn that wraps every function that gets called in a BatchGreenlet.
@@ -144,17 +284,57 @@ class BatchGreenlet(_GeventGreenlet):
     def __init__(self, *args, **kwargs):
         super(BatchGreenlet, self).__init__(*args, **kwargs)
 
-        self._links = []  # override the greenlet-native _links to use a list, which is faster for small numbers of links.
+        current = getcurrent()
+        context = getattr(current, 'context', None) or CONTEXT_FACTORY()
+        self._setup(context, getattr(current, 'deadline', None))
+        context.greenlet_created(self)
+
+        for wrapper in AUTO_WRAPPERS:
+            self._run = wrapper(self._run)
 
-        self.context = get_context() or CONTEXT_FACTORY()
-        self.context.greenlet_created(self)
-        self.rawlink(self.context.greenlet_finished)
+        if stats.LISTENERS:
+            stats.notify('greenlet_created', self)
 
+    def _setup(self, context, deadline):
+        # override the greenlet-native _links to use a list, which is faster for small numbers of links.
+        self._links = [context.greenlet_finished]
+
+        self.context = context
         self.is_blocked = True
+        # The time.time() by which batched calls made by this greenlet have to finish: inherited from
+        # the greenlet that spawned it (see deadline()), or the tightest one of a running batch.
+        self.deadline = deadline
         self._exc_info = ()
 
+    @classmethod
+    def spawn_many(cls, fn, items, **kwargs):
+        """Spawns fn(item, **kwargs) for each of items and returns the list of greenlets.
+
+        This is cheaper than calling spawn() for each item: the context is looked up (and its
+        greenlet counts updated) once, and fn is wrapped with the auto wrappers once. Outside of a
+        batch context, all of the greenlets share a single new context."""
+        current = getcurrent()
+        context = getattr(current, 'context', None) or CONTEXT_FACTORY()
+        deadline = getattr(current, 'deadline', None)
+        run = fn
         for wrapper in AUTO_WRAPPERS:
-            self._run = wrapper(self._run)
+            run = wrapper(run)
+
+        init = _GeventGreenlet.__init__
+        greenlets = []
+        for item in items:
+            g = cls.__new__(cls)
+            init(g, run, item, **kwargs)
+            g._setup(context, deadline)
+            greenlets.append(g)
+        context.greenlets_created(greenlets)
+
+        if stats.LISTENERS:
+            for g in greenlets:
+                stats.notify('greenlet_created', g)
+        for g in greenlets:
+            g.start()
+        return greenlets
 
     def _notify_links(self):
         links = self._links
@@ -177,6 +357,13 @@ class BatchGreenlet(_GeventGreenlet):
             self.context.greenlet_unblocked(self)
         return super(BatchGreenlet, self).switch(*args, **kwargs)
 
+    def throw(self, *args):
+        # Timeouts and kill() resume the greenlet with throw() instead of switch().
+        if self.is_blocked:
+            self.is_blocked = False
+            self.context.greenlet_unblocked(self)
+        return super(BatchGreenlet, self).throw(*args)
+
     def _report_error(self, exc_info):
         """Overridden to add the traceback."""
         super(BatchGreenlet, self)._report_error(exc_info)
@@ -410,6 +597,8 @@ class BatchAsyncResult(object):
             # finished normally, link was already removed in _notify_links
         return self.value
 
+    join = wait  # Compat with Greenlet, e.g. for pget().
+
     def rawlink(self, callback):
         """Register a callback to call when a value or an exception is set.
 
@@ -441,6 +630,7 @@ class BatchAsyncResult(object):
             self.set_exception(source.exception)
 
 spawn = BatchGreenlet.spawn
+spawn_many = BatchGreenlet.spawn_many
 
 def batch_context(fn):
     @wraps(fn)
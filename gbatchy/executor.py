@@ -0,0 +1,43 @@
+from gevent import get_hub
+from gevent.threadpool import ThreadPool
+import multiprocessing
+import sys
+
+_PROCESS_POOL = None
+
+def _get_process_pool():
+    global _PROCESS_POOL
+    if _PROCESS_POOL is None:
+        _PROCESS_POOL = multiprocessing.Pool()
+    return _PROCESS_POOL
+
+
+def _call_by_name(module, name, args):
+    """Runs in the worker process: @batched replaces the module attribute, so look up the original function."""
+    __import__(module)
+    fn = getattr(sys.modules[module], name)
+    return getattr(fn, 'batch_fn', fn)(args)
+
+
+def run_in_executor(executor, fn, args):
+    """Runs fn(args) in executor, cooperatively waiting for the result.
+
+    executor can be:
+     - 'thread': the hub's threadpool.
+     - 'process': a lazily created multiprocessing.Pool shared by the whole process. Only module-level
+       @batched functions are supported, and their arguments & results have to be picklable.
+     - a gevent ThreadPool, a multiprocessing Pool or a concurrent.futures Executor."""
+    if executor == 'thread':
+        return get_hub().threadpool.apply(fn, (args,))
+    elif executor == 'process':
+        pending = _get_process_pool().apply_async(_call_by_name, (fn.__module__, fn.__name__, args))
+        # Wait in a thread so the hub keeps running.
+        return get_hub().threadpool.apply(pending.get)
+    elif isinstance(executor, ThreadPool):
+        return executor.apply(fn, (args,))
+    elif hasattr(executor, 'apply_async'):
+        return get_hub().threadpool.apply(executor.apply_async(fn, (args,)).get)
+    elif hasattr(executor, 'submit'):
+        return get_hub().threadpool.apply(executor.submit(fn, args).result)
+    else:
+        raise ValueError('Unknown executor: %r' % (executor,))
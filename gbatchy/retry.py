@@ -0,0 +1,84 @@
+import gevent
+import sys
+import time
+
+from .context import may_block
+from .scheduler import Raise
+
+class RetryPolicy(object):
+    """Retries failing batches, for use as @batched(retry=RetryPolicy(...)).
+
+     - max_attempts: how many times a batch is tried before giving up on it as a whole.
+     - backoff: how long to wait before the first retry. Every retry waits `multiplier` times longer,
+       up to max_backoff.
+     - retry_on: the exceptions that are considered transient. Other exceptions aren't retried.
+     - bisect: once a batch has failed for good, split it in halves (recursively) and try each half
+       once, so only the calls that actually fail get the exception.
+
+    The counters (attempts, retries, bisections, failures and retry_time, the total number of seconds
+    spent on batches after their first failure) are shared by every function using this policy."""
+
+    def __init__(self, max_attempts=3, backoff=0.01, multiplier=2, max_backoff=1, retry_on=(Exception,),
+                 bisect=True):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on
+        self.bisect = bisect
+
+        self.attempts = 0
+        self.retries = 0
+        self.bisections = 0
+        self.failures = 0
+        self.retry_time = 0.0
+
+    def run(self, call, args):
+        """Returns call(args), retrying and bisecting args according to this policy."""
+        self.attempts += 1
+        try:
+            return call(args)
+        except Exception as ex:
+            failed_at = time.time()
+            exc_info = sys.exc_info()
+            transient = isinstance(ex, self.retry_on)
+
+        try:
+            delay = self.backoff
+            for _ in xrange(self.max_attempts - 1 if transient else 0):
+                self.retries += 1
+                with may_block():
+                    gevent.sleep(delay)
+                delay = min(delay * self.multiplier, self.max_backoff)
+
+                self.attempts += 1
+                try:
+                    return call(args)
+                except Exception as ex:
+                    exc_info = sys.exc_info()
+                    if not isinstance(ex, self.retry_on):
+                        break
+
+            if self.bisect and len(args) > 1:
+                return self._bisect(call, args)
+
+            self.failures += 1
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            self.retry_time += time.time() - failed_at
+
+    def _bisect(self, call, args):
+        self.bisections += 1
+        middle = len(args) // 2
+        return self._run_once(call, args[:middle]) + self._run_once(call, args[middle:])
+
+    def _run_once(self, call, args):
+        self.attempts += 1
+        try:
+            return list(call(args))
+        except Exception:
+            if len(args) > 1:
+                return self._bisect(call, args)
+
+            self.failures += 1
+            return [Raise(*sys.exc_info())]
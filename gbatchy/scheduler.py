@@ -1,6 +1,15 @@
+from collections import deque
+from functools import partial
+from gevent import get_hub, getcurrent, Timeout
+from itertools import chain, izip
+import math
 import sys
-from .context import BatchGreenlet
-from .utils import transform
+import time
+import weakref
+from .context import BatchGreenlet, BatchAsyncResult, DeadlineExceeded, may_block
+from .executor import run_in_executor
+from . import stats
+from .utils import Pool
 
 class Scheduler(object):
     __slots__ = []
@@ -14,66 +23,738 @@ class Scheduler(object):
     def has_work(self):
         raise NotImplementedError()
 
-    def run_batch_fn(self, fn, args):
-        try:
-            result = fn(args)
+    def run_batch(self, fn, args, futures=None, stream=None, chunk_size=None, max_parallel_chunks=None,
+                  adaptive=None, executor=None, retry=None, breaker=None, deadlines=None, call_results=None):
+        """Runs a batch using run_batch_fn, run_chunked_batch_fn or run_streaming_batch_fn, depending
+        on the options. Streaming batches set futures instead of returning a list of results.
+
+        deadlines (one time.time() deadline or None per call) and call_results (the _CallResult of
+        each call) are used to drop calls nobody is waiting for; see run_live_batch."""
+        if deadlines is not None or call_results is not None:
+            return self.run_live_batch(fn, args, futures, deadlines, call_results, stream=stream,
+                                       chunk_size=chunk_size,
+                                       max_parallel_chunks=max_parallel_chunks, adaptive=adaptive,
+                                       executor=executor, retry=retry, breaker=breaker)
+        if stream is not None:
+            self.run_streaming_batch_fn(fn, args, futures, stream, adaptive=adaptive, breaker=breaker)
+        elif chunk_size is not None:
+            return self.run_chunked_batch_fn(fn, args, chunk_size, max_parallel_chunks, adaptive=adaptive,
+                                             executor=executor, retry=retry, breaker=breaker)
+        else:
+            return self.run_batch_fn(fn, args, adaptive=adaptive, executor=executor, retry=retry, breaker=breaker)
+
+    def run_live_batch(self, fn, args, futures, deadlines, call_results, **kwargs):
+        """Drops the calls whose deadline has already passed (they fail with DeadlineExceeded) and
+        the calls whose waiters were all killed (or interrupted by a Timeout), then runs the rest.
+        If no call is left, fn isn't called at all. Calls that nobody waited for yet (e.g.
+        fire-and-forget calls made with as_future=True) always run.
+
+        The batch greenlet's deadline is set to the earliest remaining one, so the batch function
+        can use time_remaining()."""
+        now = time.time() if deadlines is not None else None
+        live = [i for i in xrange(len(args))
+                if (deadlines is None or deadlines[i] is None or deadlines[i] > now) and
+                   (call_results is None or not call_results[i].abandoned)]
+        expired = Raise(DeadlineExceeded('Deadline exceeded before the batch started.'))
 
-            if result is None:
-                result = [None] * len(args)
+        if call_results is not None:
+            cancelled = [i for i, result in enumerate(call_results) if result.abandoned]
+            del call_results[:]  # They reference the batch greenlet, which references this list.
+            if cancelled:
+                CANCELLED['calls'] += len(cancelled)
+                if not live:
+                    CANCELLED['batches'] += 1
 
-            if len(result) != len(args):
-                raise ValueError('Batch function %s did not return enough results (needed %d got %d)' % (
-                    fn, len(args), len(result)))
+        results = None
+        if not live and kwargs.get('breaker') is not None:
+            kwargs['breaker'].release()
+        if live:
+            if deadlines is not None:
+                live_deadlines = [deadlines[i] for i in live if deadlines[i] is not None]
+                getcurrent().deadline = min(live_deadlines) if live_deadlines else None
+            if len(live) == len(args):
+                return self.run_batch(fn, args, futures, **kwargs)
+            results = self.run_batch(fn, [args[i] for i in live],
+                                     [futures[i] for i in live] if futures is not None else None,
+                                     **kwargs)
+
+        if kwargs.get('stream') is not None:
+            for future in futures:
+                if not future.ready():
+                    _set_future(future, expired)
+            return None
+
+        all_results = [expired] * len(args)
+        if call_results is not None and cancelled:
+            for i in cancelled:
+                all_results[i] = Raise(CallCancelled('Call cancelled before its batch started.'))
+        for i, r in izip(live, results or ()):
+            all_results[i] = r
+        return all_results
+
+    def run_batch_fn(self, fn, args, adaptive=None, executor=None, retry=None, breaker=None):
+        timed = adaptive is not None or breaker is not None or stats.LISTENERS
+        if timed:
+            start = time.time()
+
+        failed = False
+        try:
+            if retry is None:
+                result = _call_batch_fn(fn, args, executor)
+            else:
+                result = retry.run(partial(_call_batch_fn, fn, executor=executor), args)
         except Exception:
             result = [Raise(*sys.exc_info())] * len(args)
+            failed = True
+
+        if timed:
+            duration = time.time() - start
+            if adaptive is not None:
+                adaptive.record(fn, len(args), duration)
+            if breaker is not None:
+                breaker.record(failed, duration)
+            if stats.LISTENERS:
+                stats.notify('batch_completed', _function_name(fn), len(args), duration, failed)
 
         return result
 
+    def run_chunked_batch_fn(self, fn, args, chunk_size, max_parallel_chunks=None, **kwargs):
+        """Same as run_batch_fn, but splits args into chunks of at most chunk_size calls and runs
+        up to max_parallel_chunks (default: all) of them concurrently."""
+        if len(args) <= chunk_size:
+            return self.run_batch_fn(fn, args, **kwargs)
+
+        chunks = [args[i:i + chunk_size] for i in xrange(0, len(args), chunk_size)]
+        results = Pool(max_parallel_chunks).map(partial(self.run_batch_fn, fn, **kwargs), chunks)
+        return list(chain.from_iterable(results))
+
+    def run_streaming_batch_fn(self, fn, args, futures, stream='ordered', adaptive=None, breaker=None):
+        """Runs a batch function that returns an iterator of results (or of (index, result) pairs
+        if stream == 'indexed'), setting each of futures as soon as its result is produced.
+
+        The batch greenlet counts as blocked while waiting for the next result, so the callers that
+        already got theirs can move on to their next round of batches."""
+        timed = adaptive is not None or breaker is not None or stats.LISTENERS
+        if timed:
+            start = time.time()
+
+        failed = False
+        try:
+            with may_block():
+                results = fn(args)
+                if stream == 'indexed':
+                    for index, r in results:
+                        _set_future(futures[index], r)
+                else:
+                    for index, r in enumerate(results):
+                        _set_future(futures[index], r)
+
+            missing = sum(1 for future in futures if not future.ready())
+            if missing:
+                raise ValueError('Batch function %s did not return enough results (missing %d of %d)' % (
+                    fn, missing, len(args)))
+        except Exception:
+            exc_info = sys.exc_info()
+            for future in futures:
+                if not future.ready():
+                    future.set_exc_info(exc_info)
+            failed = True
+
+        if timed:
+            duration = time.time() - start
+            if adaptive is not None:
+                adaptive.record(fn, len(args), duration)
+            if breaker is not None:
+                breaker.record(failed, duration)
+            if stats.LISTENERS:
+                stats.notify('batch_completed', _function_name(fn), len(args), duration, failed)
+
+def _call_batch_fn(fn, args, executor=None):
+    result = fn(args) if executor is None else run_in_executor(executor, fn, args)
+
+    if result is None:
+        result = [None] * len(args)
+
+    if len(result) != len(args):
+        raise ValueError('Batch function %s did not return enough results (needed %d got %d)' % (
+            fn, len(args), len(result)))
+
+    return result
+
+
+class _PendingBatch(object):
+    __slots__ = ['arg_list', 'greenlet', 'cost', 'keys', 'futures', 'call_results', 'deadlines', 'name', 'opened']
+
+    def __init__(self, arg_list, greenlet, futures=None, call_results=None, deadlines=None):
+        self.arg_list = arg_list
+        self.greenlet = greenlet
+        self.cost = 0
+        self.keys = None  # {args key: index in arg_list} when deduplicating.
+        self.futures = futures  # One BatchAsyncResult per call for streaming batches.
+        self.call_results = call_results  # The _CallResult of each call for other batches.
+        self.deadlines = deadlines  # One deadline (or None) per call, once any call has one.
+        self.name = None  # Function name & time.time() when opened, if there are stats listeners.
+        self.opened = None
+
+    def start(self, reason):
+        if self.opened is not None and stats.LISTENERS:
+            stats.notify('batch_flushed', self.greenlet.context, self.name, len(self.arg_list),
+                         time.time() - self.opened, reason)
+        self.greenlet.start()
+
+
+class _CallResult(object):
+    """An AsyncResult-like for the result of one call in a batch: a view of slot `index` in the
+    results list of `batch` (the batch greenlet or a _BatchResult).
+
+    Unlike transform(), it doesn't link itself to the batch. If all of the greenlets waiting for it
+    were killed (or interrupted by a Timeout) and nothing is linked to it (e.g. a transform()), it's
+    abandoned, and the call is dropped from the batch before it runs."""
+    __slots__ = ['batch', 'index', 'waiters', 'abandoned']
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+        self.waiters = 0
+        self.abandoned = False
+
+    @property
+    def value(self):
+        return self.get(block=False) if self.successful() else None
+
+    def ready(self):
+        return self.batch.ready()
+
+    def successful(self):
+        return self.batch.successful() and not isinstance(self.batch.value[self.index], Raise)
+
+    def get(self, block=True, timeout=None):
+        batch = self.batch
+        if not batch.ready():
+            if block:
+                self.wait(timeout=timeout)
+            batch = self.batch
+            if not batch.ready():
+                raise Timeout()
+
+        if not batch.successful():
+            batch.get()  # The batch itself failed; raise its exception.
+        r = batch.value[self.index]
+        return _unwrap(r) if isinstance(r, Raise) else r
+
+    def wait(self, timeout=None):
+        self.abandoned = False
+        self.waiters += 1
+        try:
+            end = time.time() + timeout if timeout is not None else None
+            batch = None
+            # SharedScheduler moves calls that don't make it into the next batch to a new _BatchResult.
+            while batch is not self.batch:
+                batch = self.batch
+                batch.wait(timeout=max(0, end - time.time()) if end is not None else None)
+        except:
+            self.waiters -= 1
+            self.abandoned = not self.waiters
+            raise
+        self.waiters -= 1
+        return self.value
+
+    join = wait  # Compat with Greenlet, e.g. for pget().
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def rawlink(self, callback):
+        # A link is a waiter that never leaves, so the call can't be abandoned anymore.
+        self.waiters += 1
+        self.abandoned = False
+        self._link(callback)
+
+    def _link(self, callback):
+        batch = self.batch
+        def link(_):
+            # SharedScheduler.take_batches may have moved the call to a new _BatchResult; follow it.
+            if self.batch is batch or self.batch.ready():
+                callback(self)
+            else:
+                self._link(callback)
+        batch.rawlink(link)
+
+
+class _BatchResult(BatchAsyncResult):
+    """The results of the calls queued by one context in a SharedScheduler batch, as one list.
+    Each call gets a _CallResult view of its slot; all of their waiters are notified in a single
+    pass once the last slot is filled (see _fill_call_results)."""
+    __slots__ = ['remaining']
+
+    def __init__(self, size=0):
+        super(_BatchResult, self).__init__()
+        self.value = [None] * size
+        self.remaining = size
+
+    def add(self):
+        """Returns a _CallResult for a new slot."""
+        self.value.append(None)
+        self.remaining += 1
+        return _CallResult(self, len(self.value) - 1)
+
+
+def _fill_call_results(views, results):
+    """Stores each result in the slot of its _CallResult, then sets the _BatchResults that are complete."""
+    filled = []
+    for view, r in izip(views, results):
+        batch = view.batch
+        batch.value[view.index] = r
+        batch.remaining -= 1
+        if not batch.remaining:
+            filled.append(batch)
+    for batch in filled:
+        batch.set(batch.value)
+
+
+def _add_deadline(deadlines, index, deadline):
+    """Records the deadline of the call at index, returning the (possibly new) deadlines list."""
+    if deadlines is None:
+        if deadline is None:
+            return None
+        deadlines = [None] * index
+    if index < len(deadlines):
+        # A deduplicated call: it has to run as long as any of its callers is still waiting.
+        if deadlines[index] is not None and (deadline is None or deadline > deadlines[index]):
+            deadlines[index] = deadline
+    else:
+        deadlines.append(deadline)
+    return deadlines
+
+
+def _args_key(args_tuple):
+    """Returns a hashable version of args_tuple ((args, kwargs) or args), or None if it can't be hashed."""
+    try:
+        key = tuple(frozenset(x.iteritems()) if type(x) is dict else x for x in args_tuple)
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _set_future(future, r):
+    if isinstance(r, Raise):
+        if len(r.exc_info) == 3:
+            future.set_exc_info(r.exc_info)
+        else:
+            future.set_exception(r.exc_info[0])
+    else:
+        future.set(r)
+
+
+def _unwrap(r):
+    if isinstance(r, Raise):
+        if len(r.exc_info) == 3:
+            exc, v, tb = r.exc_info
+            raise exc, v, tb
+        else:
+            raise r.exc_info[0]
+    else:
+        return r
+
+
 class AllAtOnceScheduler(Scheduler):
-    __slots__ = ['pending_batches']
+    __slots__ = ['pending_batches', 'running']
 
     def __init__(self):
-        self.pending_batches = {}  # {id: (function, [(args, kwargs), ...], [result, result, ...])}
+        self.pending_batches = {}  # {id: _PendingBatch}
+        self.running = 0  # Batch greenlets that haven't finished yet, see set_hang_threshold.
+
+    def run_pending_batch(self, id_, function, args_tuple, max_size=sys.maxint, cost=None, max_cost=None,
+                          adaptive=None, chunk_size=None, max_parallel_chunks=None, dedupe=False, executor=None,
+                          stream=None, retry=None, breaker=None, deadline=None, max_per_context=None):
+        """Queues args_tuple for the next call of function.
+
+         - max_size: the maximum number of calls to coalesce into one batch.
+         - cost/max_cost: cost(args_tuple) estimates the weight of a single call (it defaults to 1);
+           the batch is started as soon as the summed cost reaches max_cost. A call that would take
+           a non-empty batch over max_cost starts it and goes into the next one instead.
+         - adaptive: an AdaptiveBatchSize that further limits max_size based on observed latency.
+         - chunk_size/max_parallel_chunks: when the batch runs, it is split into calls of at most
+           chunk_size items, max_parallel_chunks of which run concurrently.
+         - dedupe: identical (hashable) calls in the same batch share a single entry in the arg list.
+         - executor: runs the batch function in a thread or process pool (see run_in_executor).
+         - stream: 'ordered' or 'indexed' if function returns an iterator of results rather than a list
+           (see run_streaming_batch_fn). chunk_size, executor and retry don't apply to these.
+         - retry: a RetryPolicy for failing batches.
+         - breaker: a CircuitBreaker. While it's open, calls fail right away without being queued.
+         - deadline: the time.time() after which this call is dropped from the batch if it hasn't
+           started yet.
+         - max_per_context: only used by SharedScheduler, so that @batched functions can set it
+           regardless of the scheduler."""
+        batch = self.pending_batches.get(id_)
+        key = _args_key(args_tuple) if dedupe else None
+
+        if max_cost is not None:
+            call_cost = cost(args_tuple) if cost is not None else 1
+            if batch is not None and batch.cost + call_cost > max_cost and (key is None or key not in batch.keys):
+                # Send what's pending rather than going over max_cost with this call.
+                self.pending_batches.pop(id_)
+                batch.start('full')
+                batch = None
+
+        if batch is None:
+            if breaker is not None:
+                breaker = breaker.circuit(id_, function)
+                if not breaker.allow():
+                    return breaker.reject()
 
-    def run_pending_batch(self, id_, function, args_tuple, max_size=sys.maxint):
-        if id_ not in self.pending_batches:
             arg_list = [args_tuple]
+            futures = [BatchAsyncResult()] if stream is not None else None
+            call_results = [] if stream is None else None
             # Make sure to init early so any contexts from the call propagate.
             # Lists are mutable so future appends will make it to the args list.
-            greenlet = BatchGreenlet(self.run_batch_fn, function, arg_list)
-            self.pending_batches[id_] = (arg_list, greenlet)
+            greenlet = BatchGreenlet(self.run_batch, function, arg_list, futures, stream=stream,
+                                     chunk_size=chunk_size, max_parallel_chunks=max_parallel_chunks,
+                                     adaptive=adaptive, executor=executor, retry=retry, breaker=breaker,
+                                     call_results=call_results)
+            self.running += 1
+            greenlet.rawlink(self._batch_finished)
+            batch = self.pending_batches[id_] = _PendingBatch(arg_list, greenlet, futures, call_results)
+            if dedupe:
+                batch.keys = {}
+            if stats.LISTENERS:
+                batch.name, batch.opened = _function_name(function), time.time()
+                stats.notify('batch_opened', greenlet.context, batch.name)
         else:
-            arg_list, greenlet = self.pending_batches[id_]
+            arg_list, greenlet = batch.arg_list, batch.greenlet
+            if key is not None and key in batch.keys:
+                if batch.deadlines is not None:
+                    _add_deadline(batch.deadlines, batch.keys[key], deadline)
+                if batch.futures is not None:
+                    return batch.futures[batch.keys[key]]
+                result = batch.call_results[batch.keys[key]]
+                result.abandoned = False  # There's a new caller.
+                return result
             arg_list.append(args_tuple)
+            if batch.futures is not None:
+                batch.futures.append(BatchAsyncResult())
 
         index = len(arg_list) - 1
+        if key is not None:
+            batch.keys[key] = index
 
-        if index >= max_size - 1:
-            self.pending_batches.pop(id_)
-            greenlet.start()
-
-        def result_transform(result):
-            r = result.get()[index]
-            if isinstance(r, Raise):
-                if len(r.exc_info) == 3:
-                    exc, v, tb = r.exc_info
-                    raise exc, v, tb
-                else:
-                    raise r.exc_info[0]
+        if deadline is not None or batch.deadlines is not None:
+            if batch.deadlines is None:
+                greenlet.kwargs['deadlines'] = batch.deadlines = _add_deadline(None, index, deadline)
             else:
-                return r
+                _add_deadline(batch.deadlines, index, deadline)
 
-        return transform(greenlet, result_transform)
+        if adaptive is not None and adaptive.limit < max_size:
+            max_size = adaptive.limit
+
+        if max_cost is not None:
+            batch.cost += call_cost
+
+        if batch.futures is not None:
+            result = batch.futures[index]
+        else:
+            result = _CallResult(greenlet, index)
+            batch.call_results.append(result)
+
+        if index >= max_size - 1 or (max_cost is not None and batch.cost >= max_cost):
+            self.pending_batches.pop(id_)
+            batch.start('full')
+
+        return result
 
     def has_work(self):
         return bool(self.pending_batches)
 
-    def run_next(self):
+    def _batch_finished(self, greenlet):
+        self.running -= 1
+
+    def run_next(self, reason='round'):
         assert self.pending_batches
 
         self.pending_batches, pending_batches = {}, self.pending_batches
-        for _, greenlet in pending_batches.itervalues():
-            greenlet.start()
+        for batch in pending_batches.itervalues():
+            batch.start(reason)
+
+
+class TimeWindowScheduler(AllAtOnceScheduler):
+    """Same as AllAtOnceScheduler, but pending batches are also flushed once they have waited for
+    max_latency seconds, even if some greenlets in the context never block (e.g. because they are
+    busy doing other I/O).
+
+    To use it everywhere: set_default_scheduler(partial(TimeWindowScheduler, max_latency=0.002))"""
+    __slots__ = ['max_latency', '_timer']
+
+    DEFAULT_MAX_LATENCY = 0.002
+
+    def __init__(self, max_latency=None):
+        super(TimeWindowScheduler, self).__init__()
+        self.max_latency = max_latency if max_latency is not None else self.DEFAULT_MAX_LATENCY
+        self._timer = None
+
+    def run_pending_batch(self, *args, **kwargs):
+        result = super(TimeWindowScheduler, self).run_pending_batch(*args, **kwargs)
+
+        if self.pending_batches:
+            timer = self._timer
+            if timer is None:
+                timer = self._timer = get_hub().loop.timer(self.max_latency)
+            if not timer.active:
+                timer.start(self._flush)
+
+        return result
+
+    def _flush(self):
+        if self.pending_batches:
+            self.run_next('timer')
+
+    def run_next(self, reason='round'):
+        if self._timer is not None:
+            self._timer.stop()
+
+        super(TimeWindowScheduler, self).run_next(reason)
+
+
+class _SharedPendingBatch(object):
+    __slots__ = ['function', 'arg_list', 'futures', 'result', 'deadlines', 'max_size', 'max_per_context', 'adaptive',
+                 'kwargs']
+
+    def __init__(self, function, max_size, max_per_context, adaptive, kwargs):
+        self.function = function
+        self.arg_list = []
+        self.futures = []  # One BatchAsyncResult per call for streaming batches, _CallResult views of result otherwise.
+        self.result = _BatchResult() if kwargs['stream'] is None else None
+        self.deadlines = None  # Same as _PendingBatch.deadlines
+        self.max_size = max_size
+        self.max_per_context = max_per_context
+        self.adaptive = adaptive
+        self.kwargs = kwargs  # For run_batch
+
+
+class SharedScheduler(Scheduler):
+    """A scheduler that merges the batches of every context in the same hub.
+
+    Each context still decides when it is ready to flush (i.e. when all of its greenlets are
+    blocked), but instead of running its own batches it hands them over to a per-hub batcher. At
+    the end of the hub tick, the batcher calls each batch function once for all of the ready
+    contexts, and fans the results back out to each context's futures.
+
+    To keep one context from starving the others, at most max_per_context calls from a single
+    context go into each merged batch; the rest are sent in the following ticks.
+
+    Supported @batched options are max_size, max_per_context, adaptive, chunk_size,
+    max_parallel_chunks, executor, stream, retry and breaker; the others (e.g. cost/max_cost or dedupe)
+    are ignored.
+
+    To use it everywhere: set_default_scheduler(SharedScheduler)"""
+    __slots__ = ['pending_batches', 'max_per_context', 'is_ready', 'running']
+
+    DEFAULT_MAX_PER_CONTEXT = 1000
+
+    def __init__(self, max_per_context=None):
+        self.pending_batches = {}  # {id: _SharedPendingBatch}
+        self.max_per_context = max_per_context if max_per_context is not None else self.DEFAULT_MAX_PER_CONTEXT
+        self.is_ready = False
+        self.running = 0  # Merged batches with calls from this scheduler that haven't finished yet.
+
+    def run_pending_batch(self, id_, function, args_tuple, max_size=sys.maxint, max_per_context=None,
+                          adaptive=None, chunk_size=None, max_parallel_chunks=None, executor=None, stream=None,
+                          retry=None, breaker=None, deadline=None, **kwargs):
+        batch = self.pending_batches.get(id_)
+        if batch is None:
+            if breaker is not None:
+                breaker = breaker.circuit(id_, function)
+                if not breaker.allow():
+                    return breaker.reject()
+
+            batch = self.pending_batches[id_] = _SharedPendingBatch(
+                function, max_size, max_per_context or self.max_per_context, adaptive,
+                dict(stream=stream, chunk_size=chunk_size, max_parallel_chunks=max_parallel_chunks,
+                     adaptive=adaptive, executor=executor, retry=retry, breaker=breaker))
+
+        future = BatchAsyncResult() if batch.result is None else batch.result.add()
+        batch.arg_list.append(args_tuple)
+        batch.futures.append(future)
+        if deadline is not None or batch.deadlines is not None:
+            batch.deadlines = _add_deadline(batch.deadlines, len(batch.arg_list) - 1, deadline)
+        return future
+
+    def has_work(self):
+        return bool(self.pending_batches)
+
+    def run_next(self):
+        assert self.pending_batches
+
+        if not self.is_ready:
+            self.is_ready = True
+            _get_shared_batcher().add_ready(self)
+
+    def take_batches(self):
+        """Returns [(id, batch)] with at most max_per_context calls per batch. Anything left over stays pending."""
+        self.is_ready = False
+        taken = []
+        for id_, batch in self.pending_batches.items():
+            limit = batch.max_per_context
+            if len(batch.arg_list) <= limit:
+                del self.pending_batches[id_]
+                taken.append((id_, batch))
+            else:
+                head = _SharedPendingBatch(batch.function, batch.max_size, limit, batch.adaptive, batch.kwargs)
+                head.arg_list, batch.arg_list = batch.arg_list[:limit], batch.arg_list[limit:]
+                head.futures, batch.futures = batch.futures[:limit], batch.futures[limit:]
+                if batch.deadlines is not None:
+                    head.deadlines, batch.deadlines = batch.deadlines[:limit], batch.deadlines[limit:]
+                if batch.result is not None:
+                    # The head keeps the current _BatchResult; the leftovers move to a new one, so the
+                    # head's callers don't have to wait for them.
+                    head.result, batch.result = batch.result, _BatchResult(len(batch.futures))
+                    del head.result.value[limit:]
+                    head.result.remaining = limit
+                    for index, view in enumerate(batch.futures):
+                        view.batch, view.index = batch.result, index
+                taken.append((id_, head))
+        return taken
+
+
+class _SharedBatcher(object):
+    __slots__ = ['hub', 'ready', '_scheduled_callback']
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.ready = []
+        self._scheduled_callback = None
+
+    def add_ready(self, scheduler):
+        self.ready.append(scheduler)
+        if not self._scheduled_callback:
+            self._scheduled_callback = self.hub.loop.run_callback(self._flush)
+
+    def _flush(self):
+        self._scheduled_callback = None
+        ready, self.ready = self.ready, []
+
+        merged = {}  # {id: ([scheduler], _SharedPendingBatch)}
+        for scheduler in ready:
+            for id_, batch in scheduler.take_batches():
+                into = merged.get(id_)
+                if into is None:
+                    merged[id_] = ([scheduler], batch)
+                else:
+                    into[0].append(scheduler)
+                    into = into[1]
+                    if into.deadlines is not None or batch.deadlines is not None:
+                        into.deadlines = ((into.deadlines or [None] * len(into.arg_list)) +
+                                          (batch.deadlines or [None] * len(batch.arg_list)))
+                    into.arg_list.extend(batch.arg_list)
+                    into.futures.extend(batch.futures)
+
+            if scheduler.pending_batches:
+                # Leftovers due to max_per_context go out in the next tick.
+                scheduler.run_next()
+
+        for schedulers, batch in merged.itervalues():
+            max_size = batch.max_size
+            adaptive = batch.adaptive
+            if adaptive is not None and adaptive.limit < max_size:
+                max_size = adaptive.limit
+            deadlines = batch.deadlines
+            for start in xrange(0, len(batch.arg_list), max_size):
+                # Spawned from the hub, so each batch runs in its own context.
+                greenlet = BatchGreenlet.spawn(self._run_batch, schedulers[0], batch.function,
+                                               batch.arg_list[start:start + max_size],
+                                               batch.futures[start:start + max_size],
+                                               deadlines[start:start + max_size] if deadlines is not None else None,
+                                               batch.kwargs)
+                for scheduler in schedulers:
+                    scheduler.running += 1
+                greenlet.rawlink(partial(self._batch_finished, schedulers))
+
+    @staticmethod
+    def _batch_finished(schedulers, greenlet):
+        for scheduler in schedulers:
+            scheduler.running -= 1
+
+    @staticmethod
+    def _run_batch(scheduler, function, arg_list, futures, deadlines, kwargs):
+        results = scheduler.run_batch(function, arg_list, futures, deadlines=deadlines, **kwargs)
+        if results is not None:
+            _fill_call_results(futures, results)
+
+
+_SHARED_BATCHERS = weakref.WeakKeyDictionary()
+
+def _get_shared_batcher():
+    hub = get_hub()
+    batcher = _SHARED_BATCHERS.get(hub)
+    if batcher is None:
+        batcher = _SHARED_BATCHERS[hub] = _SharedBatcher(hub)
+    return batcher
+
+
+CANCELLED = {'calls': 0, 'batches': 0}
+
+class CallCancelled(Exception):
+    """The result of a call that was dropped from its batch because nobody was waiting for it anymore."""
+
+def cancelled_calls():
+    """Returns how many calls were dropped from their batch because nobody was waiting for them
+    anymore, and how many batches were skipped altogether because of that."""
+    return dict(CANCELLED)
+
+
+_ADAPTIVE_BATCH_SIZES = weakref.WeakSet()
+
+def adaptive_limits():
+    """Returns {function name: current max batch size} for every AdaptiveBatchSize in use."""
+    return {adaptive.name: adaptive.limit for adaptive in _ADAPTIVE_BATCH_SIZES if adaptive.name is not None}
+
+
+class AdaptiveBatchSize(object):
+    """Adjusts the maximum batch size of a batch function so that the p99 latency of its batches stays
+    under target_latency (in seconds), AIMD-style: the limit grows by `increase` every time a full batch
+    meets the target and gets multiplied by `decrease` as soon as the observed p99 misses it.
+
+    Use it as @batched(adaptive=AdaptiveBatchSize(0.05)). The current limit is available as .limit
+    (or through adaptive_limits()). A single instance tracks a single function."""
+
+    def __init__(self, target_latency, initial_size=100, min_size=1, max_size=10000,
+                 increase=1, decrease=0.5, window=100, percentile=0.99):
+        self.target_latency = target_latency
+        self.limit = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.increase = increase
+        self.decrease = decrease
+        self.percentile = percentile
+        self.latencies = deque(maxlen=window)
+        self.name = None
+
+        _ADAPTIVE_BATCH_SIZES.add(self)
+
+    def p99(self):
+        """Returns the latency at self.percentile of the recently observed batches (or None)."""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(math.ceil(self.percentile * len(latencies))) - 1]
+
+    def record(self, fn, size, duration):
+        if self.name is None:
+            self.name = _function_name(fn)
+
+        self.latencies.append(duration)
+
+        if self.p99() > self.target_latency:
+            self.limit = max(self.min_size, int(self.limit * self.decrease))
+            # Start over so the new limit gets judged on its own batches.
+            self.latencies.clear()
+        elif size >= self.limit:
+            self.limit = min(self.max_size, self.limit + self.increase)
+
+
+def _function_name(fn):
+    fn = getattr(fn, 'func', fn)  # class_batched uses functools.partial
+    return getattr(fn, '__name__', None) or repr(fn)
 
 
 class Raise(object):
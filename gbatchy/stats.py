@@ -0,0 +1,161 @@
+"""Hooks for observing what the schedulers do.
+
+Listeners (see StatsListener) get called when:
+ - greenlet_created(greenlet)/greenlet_finished(greenlet): a BatchGreenlet (greenlet.context is its
+   context) was created or finished.
+ - batch_opened(context, name): a call gets queued for a function that has no pending batch.
+ - round_started(context): all the greenlets of context are blocked, so its scheduler runs.
+ - batch_flushed(context, name, size, queued, reason): a pending batch is started, `queued` seconds
+   after it was opened. reason is 'round', 'full' (max_size/max_cost) or 'timer' (TimeWindowScheduler).
+ - batch_completed(name, size, duration, failed): a batch function returned or raised. This runs
+   in the batch greenlet.
+ - context_finished(context, rounds, duration): all the greenlets of a batch context finished,
+   after `rounds` rounds of batches.
+
+When no listener is registered, all this costs is a check of LISTENERS in a few places."""
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+LISTENERS = []
+
+def add_stats_listener(listener):
+    """Registers listener (a StatsListener or anything with the same methods) for every context."""
+    LISTENERS.append(listener)
+
+def remove_stats_listener(listener):
+    LISTENERS.remove(listener)
+
+def notify(event, *args):
+    for listener in LISTENERS:
+        try:
+            getattr(listener, event)(*args)
+        except Exception:
+            logger.exception('Stats listener %r failed on %s', listener, event)
+
+
+class StatsListener(object):
+    """Base class for stats listeners. All the hooks do nothing by default."""
+
+    def greenlet_created(self, greenlet):
+        pass
+
+    def greenlet_finished(self, greenlet):
+        pass
+
+    def batch_opened(self, context, name):
+        pass
+
+    def round_started(self, context):
+        pass
+
+    def batch_flushed(self, context, name, size, queued, reason):
+        pass
+
+    def batch_completed(self, name, size, duration, failed):
+        pass
+
+    def context_finished(self, context, rounds, duration):
+        pass
+
+
+class Histogram(object):
+    """Counts values into power-of-two buckets. Percentiles are the upper bound of their bucket."""
+    __slots__ = ['count', 'total', 'min', 'max', 'buckets']
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}  # {exponent: count} for values in [2 ** (exponent - 1), 2 ** exponent)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        exponent = math.frexp(value)[1] if value > 0 else None
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    @property
+    def mean(self):
+        return float(self.total) / self.count if self.count else None
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+
+        needed = p * self.count
+        seen = 0
+        for exponent in sorted(self.buckets, key=lambda e: e if e is not None else float('-inf')):
+            seen += self.buckets[exponent]
+            if seen >= needed:
+                return min(math.ldexp(1, exponent), self.max) if exponent is not None else 0
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'min': self.min, 'max': self.max,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99)}
+
+
+class FunctionStats(object):
+    __slots__ = ['batches', 'errors', 'size', 'queued', 'duration']
+
+    def __init__(self):
+        self.batches = 0
+        self.errors = 0
+        self.size = Histogram()
+        self.queued = Histogram()  # Seconds between the first call and the start of the batch.
+        self.duration = Histogram()  # Seconds spent in the batch function.
+
+    def to_dict(self):
+        return {'batches': self.batches, 'errors': self.errors, 'size': self.size.to_dict(),
+                'queued': self.queued.to_dict(), 'duration': self.duration.to_dict()}
+
+
+class BatchStats(StatsListener):
+    """An in-memory StatsListener that aggregates FunctionStats by batch function name, and
+    histograms of rounds and duration per batch context.
+
+    stats = BatchStats()
+    add_stats_listener(stats)
+    ...
+    stats.summary()  # {'functions': {name: {...}}, 'rounds': {...}, 'contexts': {...}}"""
+
+    def __init__(self):
+        self.functions = {}  # {name: FunctionStats}
+        self.rounds = Histogram()
+        self.context_duration = Histogram()
+
+    def _get(self, name):
+        stats = self.functions.get(name)
+        if stats is None:
+            stats = self.functions[name] = FunctionStats()
+        return stats
+
+    def batch_flushed(self, context, name, size, queued, reason):
+        self._get(name).queued.add(queued)
+
+    def batch_completed(self, name, size, duration, failed):
+        stats = self._get(name)
+        stats.batches += 1
+        stats.errors += bool(failed)
+        stats.size.add(size)
+        stats.duration.add(duration)
+
+    def context_finished(self, context, rounds, duration):
+        self.rounds.add(rounds)
+        self.context_duration.add(duration)
+
+    def summary(self):
+        return {'functions': {name: stats.to_dict() for name, stats in self.functions.iteritems()},
+                'rounds': self.rounds.to_dict(),
+                'contexts': self.context_duration.to_dict()}
+
+    def reset(self):
+        self.__init__()
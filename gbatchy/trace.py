@@ -0,0 +1,132 @@
+"""A stats listener that records what happens in each batch context, for use with a trace viewer.
+
+with tracing() as tracer:
+    handle_request()
+with open('trace.json', 'w') as f:
+    tracer.dump(f)
+
+Then load trace.json in chrome://tracing (or ui.perfetto.dev). Each batch context is a process:
+its first row shows when rounds started and which batches they flushed, and every greenlet gets
+its own row with the batch functions it ran. Dependent rounds that could have been merged show
+up as a staircase."""
+from collections import OrderedDict
+from contextlib import contextmanager
+from gevent import getcurrent
+import json
+import time
+import weakref
+
+from .stats import StatsListener, add_stats_listener, remove_stats_listener
+
+SCHEDULER_TID = 0
+
+
+def _now():
+    return int(time.time() * 1e6)
+
+
+class _Timeline(object):
+    __slots__ = ['number', 'events', 'rounds']
+
+    def __init__(self, number):
+        self.number = number
+        self.events = [{'name': 'process_name', 'ph': 'M', 'pid': number, 'tid': SCHEDULER_TID,
+                        'args': {'name': 'context %d' % number}}]
+        self.rounds = 0
+
+
+class Tracer(StatsListener):
+    """Records a timeline of events per batch context. Only the last max_contexts finished
+    contexts are kept."""
+
+    def __init__(self, max_contexts=100):
+        self.max_contexts = max_contexts
+        self.finished = []  # [_Timeline]
+        self._active = OrderedDict()  # {id(context): _Timeline}
+        self._started = weakref.WeakKeyDictionary()  # {greenlet: start timestamp}
+        self._count = 0
+
+    def _timeline(self, context):
+        timeline = self._active.get(id(context))
+        if timeline is None:
+            self._count += 1
+            timeline = self._active[id(context)] = _Timeline(self._count)
+        return timeline
+
+    def _add(self, context, tid, **event):
+        if context is None:
+            return
+        timeline = self._timeline(context)
+        event.setdefault('ts', _now())
+        event['pid'] = timeline.number
+        event['tid'] = tid
+        timeline.events.append(event)
+
+    def greenlet_created(self, greenlet):
+        self._started[greenlet] = _now()
+
+    def greenlet_finished(self, greenlet):
+        start = self._started.pop(greenlet, None)
+        if start is not None:
+            run = getattr(greenlet, '_run', None)
+            self._add(greenlet.context, id(greenlet), name=getattr(run, '__name__', None) or repr(run),
+                      ph='X', ts=start, dur=_now() - start, cat='greenlet')
+
+    def batch_opened(self, context, name):
+        self._add(context, SCHEDULER_TID, name='open %s' % name, ph='i', s='t', cat='batch')
+
+    def round_started(self, context):
+        timeline = self._timeline(context)
+        timeline.rounds += 1
+        self._add(context, SCHEDULER_TID, name='round %d' % timeline.rounds, ph='i', s='p', cat='round',
+                  args={'trigger': 'all greenlets blocked'})
+
+    def batch_flushed(self, context, name, size, queued, reason):
+        self._add(context, SCHEDULER_TID, name='flush %s' % name, ph='i', s='t', cat='batch',
+                  args={'size': size, 'queued_ms': queued * 1e3, 'reason': reason})
+
+    def batch_completed(self, name, size, duration, failed):
+        current = getcurrent()
+        dur = int(duration * 1e6)
+        self._add(getattr(current, 'context', None), id(current), name=name, ph='X', ts=_now() - dur, dur=dur,
+                  cat='batch_fn', args={'size': size, 'failed': failed})
+
+    def context_finished(self, context, rounds, duration):
+        self._finish(id(context))
+
+    def _finish(self, key):
+        timeline = self._active.pop(key, None)
+        if timeline is not None:
+            self.finished.append(timeline)
+            del self.finished[:-self.max_contexts]
+
+    def flush(self):
+        """Counts every context that is still active as finished, e.g. because its context_finished
+        event (which fires in a hub callback) hasn't happened yet."""
+        for key in self._active.keys():
+            self._finish(key)
+
+    def timelines(self):
+        """Returns the timelines of the finished contexts, then the ones still running."""
+        return self.finished + list(self._active.itervalues())
+
+    def to_chrome_trace(self):
+        """Returns the trace in the Chrome trace-event format."""
+        return {'traceEvents': [event for timeline in self.timelines() for event in timeline.events],
+                'displayTimeUnit': 'ms'}
+
+    def dump(self, fp):
+        json.dump(self.to_chrome_trace(), fp)
+
+
+@contextmanager
+def tracing(tracer=None):
+    """Registers a Tracer (a new one by default) for the duration of the with block. Contexts that
+    haven't finished by the end of the block are flushed, so the tracer has them all."""
+    tracer = tracer if tracer is not None else Tracer()
+    add_stats_listener(tracer)
+    try:
+        yield tracer
+    finally:
+        remove_stats_listener(tracer)
+        tracer.flush()
@@ -1,12 +1,13 @@
 from collections import deque, OrderedDict
-from gevent import Timeout, iwait as _gevent_iwait, wait as _gevent_wait, pool as _gevent_pool, queue as _gevent_queue, sleep
+from gevent import getcurrent, Timeout, iwait as _gevent_iwait, wait as _gevent_wait, pool as _gevent_pool, queue as _gevent_queue, sleep
 try:
     from peak.util.proxies import LazyProxy
 except ImportError:
     from objproxies import LazyProxy
 import sys
+import weakref
 
-from .context import batch_context, spawn, add_exc_info_container, raise_exc_info_from_container, may_block, BatchGreenlet
+from .context import batch_context, spawn, spawn_many, add_exc_info_container, raise_exc_info_from_container, may_block, BatchGreenlet
 
 @batch_context
 def iwait(*args, **kwargs):
@@ -26,26 +27,45 @@ def wait(*args, **kwargs):
 @batch_context
 def pget(lst):
     """Given a list of pending things, get()s all of them"""
-    lst = list(lst)
+    if type(lst) is not list:
+        lst = list(lst)
     for x in lst:
         x.join()
     return [x.get() for x in lst]
 
+# The functions returned by @batched & co, which all take as_future=True. This is checked by identity:
+# functools.wraps copies attributes like batch_fn to any wrapper of them.
+_BATCHED_FUNCTIONS = weakref.WeakSet()
+
+def _can_queue(fn, kwargs):
+    """Whether pmap/pfilter can queue the calls to fn directly (with as_future=True) instead of
+    spawning a greenlet for each: fn has to be @batched, and there can't be a deadline, since
+    nothing would enforce it while waiting for the futures."""
+    return (getattr(fn, '__func__', fn) in _BATCHED_FUNCTIONS and 'batch_timeout' not in kwargs and
+            getcurrent().deadline is None)
+
 @batch_context
 def pmap(fn, items, **kwargs):
-    return pget(spawn(fn, i, **kwargs) for i in items)
+    if _can_queue(fn, kwargs):
+        return [f.get() for f in [fn(i, as_future=True, **kwargs) for i in items]]
+    return pget(spawn_many(fn, items, **kwargs))
 
 @batch_context
 def pmap_unordered(fn, items, **kwargs):
     """Same as the above, but returns an unordered generator that returns items as they finish."""
-    return (r.get() for r in iwait([spawn(fn, i, **kwargs) for i in items]))
+    return (r.get() for r in iwait(spawn_many(fn, items, **kwargs)))
 
 @batch_context
 def pfilter(fn, items, **kwargs):
-    items = [(spawn(fn, i, **kwargs), i) for i in items]
-    for g, _ in items:
+    items = list(items)
+    if _can_queue(fn, kwargs):
+        results = [f.get() for f in [fn(i, as_future=True, **kwargs) for i in items]]
+        return [i for r, i in zip(results, items) if r]
+
+    greenlets = spawn_many(fn, items, **kwargs)
+    for g in greenlets:
         g.join()
-    return [i for r, i in items if r.get()]
+    return [i for r, i in zip(greenlets, items) if r.get()]
 
 @batch_context
 def pfilter_unordered(fn, items, **kwargs):
@@ -129,6 +149,8 @@ class _ImmediateResult(object):
     def wait(self, timeout=None):
         return self.value
 
+    join = wait  # Compat with Greenlet, e.g. for pget().
+
     def get_nowait(self):
         return self.get()
 
@@ -201,6 +223,8 @@ class _TransformedResult(object):
 
         return self.value
 
+    join = wait  # Compat with Greenlet, e.g. for pget().
+
     def get_nowait(self):
         return self.get(block=False)
 
@@ -292,6 +316,8 @@ class _ChainedResult(object):
 
         return self.current_future.value
 
+    join = wait  # Compat with Greenlet, e.g. for pget().
+
     def get_nowait(self):
         return self.get(block=False)
 
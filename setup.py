@@ -16,7 +16,7 @@ setup(
     url='https://github.com/mikekap/gbatchy',
     author='Mike Kaplinskiy',
     author_email='mike.kaplinskiy@gmail.com',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     include_package_data=True,
     install_requires=[
         'gevent>1.0.9',
@@ -1,12 +1,26 @@
 from unittest import TestCase
+import functools
+import logging
+import os
+import thread
 
 import gevent
+import gevent.event
 from gevent.lock import BoundedSemaphore
 
-from gbatchy.context import spawn, batch_context, BatchAsyncResult
-from gbatchy.batch import batched
-from gbatchy.scheduler import Raise
-from gbatchy.utils import pmap, pfilter, pmap_unordered, pfilter_unordered, spawn_proxy, transform, chain, immediate, Pool
+from gbatchy.context import (spawn, spawn_many, batch_context, BatchAsyncResult, set_default_scheduler, deadline, time_remaining,
+                             DeadlineExceeded, set_hang_threshold, may_block, get_context)
+from gbatchy.breaker import CircuitBreaker, CircuitOpenError
+from gbatchy.cache import LRUCache
+from gbatchy.retry import RetryPolicy
+from gbatchy.batch import batched, class_batched, keyed_batched, class_keyed_batched
+from gbatchy.scheduler import (Raise, AllAtOnceScheduler, TimeWindowScheduler, SharedScheduler, AdaptiveBatchSize,
+                               adaptive_limits, cancelled_calls, CallCancelled)
+from gbatchy.utils import pget, pmap, pfilter, pmap_unordered, pfilter_unordered, spawn_proxy, transform, chain, immediate, Pool
+
+@batched(accepts_kwargs=False, executor='process')
+def _process_fn(arg_list):
+    return [(args[0], os.getpid()) for args in arg_list]
 
 class BatchTests(TestCase):
     def setUp(self):
@@ -57,6 +71,146 @@ class BatchTests(TestCase):
 
         test()
 
+    def test_batch_max_cost_works(self):
+        CALLS = []
+        @batched(accepts_kwargs=False, cost=lambda args: len(args[0]), max_cost=4)
+        def fn(arg_list):
+            CALLS.append([args[0] for args in arg_list])
+            return [len(args[0]) for args in arg_list]
+
+        @batch_context
+        def test():
+            a, b, c = spawn(fn, [1, 2, 3]), spawn(fn, [4]), spawn(fn, [5, 6])
+            self.assertEquals((3, 1, 2), (a.get(), b.get(), c.get()))
+            self.assertEquals([[[1, 2, 3], [4]], [[5, 6]]], CALLS)
+
+        test()
+
+        # A call that would go over max_cost starts the pending batch instead of joining it.
+        del CALLS[:]
+        self.assertEquals([3, 9, 1], pmap(fn, [[1, 2, 3], range(9), [4]]))
+        self.assertEquals([[[1, 2, 3]], [range(9)], [[4]]], CALLS)
+
+    def test_adaptive_batch_size(self):
+        CALLS = []
+        adaptive = AdaptiveBatchSize(target_latency=10, initial_size=2)
+        @batched(adaptive=adaptive)
+        def adaptive_fn(arg_list):
+            CALLS.append(len(arg_list))
+
+        @batch_context
+        def test():
+            pmap(adaptive_fn, [1, 2, 3])
+
+        test()
+        self.assertEquals([2, 1], CALLS)
+        self.assertEquals(3, adaptive.limit)
+        self.assertEquals(3, adaptive_limits()['adaptive_fn'])
+
+        adaptive.record(adaptive_fn, 1, 0.01)
+        self.assertEquals(3, adaptive.limit)
+        adaptive.record(adaptive_fn, 3, 11)
+        self.assertEquals(1, adaptive.limit)
+        adaptive.record(adaptive_fn, 1, 11)
+        self.assertEquals(1, adaptive.limit)
+
+    def test_batch_chunk_size(self):
+        CALLS = []
+        RUNNING = [0, 0]
+        @batched(accepts_kwargs=False, chunk_size=2, max_parallel_chunks=2)
+        def fn(arg_list):
+            CALLS.append(len(arg_list))
+            RUNNING[0] += 1
+            RUNNING[1] = max(RUNNING)
+            gevent.sleep(0.001)
+            RUNNING[0] -= 1
+            return [args[0] * 2 for args in arg_list]
+
+        @batch_context
+        def test():
+            return pmap(fn, xrange(7))
+
+        self.assertEquals([0, 2, 4, 6, 8, 10, 12], test())
+        self.assertEquals([2, 2, 2, 1], CALLS)
+        self.assertEquals(2, RUNNING[1])
+
+    def test_batch_dedupe(self):
+        CALLS = []
+        @batched(dedupe=True)
+        def fn(arg_list):
+            CALLS.append(arg_list)
+            return [args[0] + kwargs.get('n', 0) for args, kwargs in arg_list]
+
+        class Thing(object):
+            @class_batched(accepts_kwargs=False, dedupe=True)
+            def fn(self, arg_list):
+                CALLS.append(arg_list)
+                return [args[0] for args in arg_list]
+
+        @batch_context
+        def test():
+            self.assertEquals([1, 2, 1, 1], pmap(fn, [1, 2, 1, 1], n=0))
+            self.assertEquals([[((1,), {'n': 0}), ((2,), {'n': 0})]], CALLS)
+
+            del CALLS[:]
+            self.assertEquals([[1], [1], [2]], pmap(Thing().fn, [[1], [1], [2]]))
+            # Unhashable arguments don't get deduplicated.
+            self.assertEquals([[([1],), ([1],), ([2],)]], CALLS)
+
+            del CALLS[:]
+            self.assertEquals(['a', 'a'], pmap(Thing().fn, ['a', 'a']))
+            self.assertEquals([[('a',)]], CALLS)
+
+            del CALLS[:]
+            self.assertEquals([1, 1], pmap(fn, [1, 1], opts=[1, 2]))
+            self.assertEquals([[((1,), {'opts': [1, 2]}), ((1,), {'opts': [1, 2]})]], CALLS)
+
+        test()
+
+    def test_context_cache(self):
+        CALLS = []
+        @batched(accepts_kwargs=False, cache='context')
+        def fn(arg_list):
+            CALLS.append([args[0] for args in arg_list])
+            return [args[0] * 2 for args in arg_list]
+
+        @batch_context
+        def test():
+            self.assertEquals([2, 4], pmap(fn, [1, 2]))
+            self.assertEquals([2, 4, 6], pmap(fn, [1, 2, 3]))
+            self.assertEquals([[1, 2], [3]], CALLS)
+
+            future = fn(1, as_future=True)
+            self.assertTrue(future.ready())
+            self.assertEquals(2, future.get())
+            self.assertEquals([2, 4, 6], pget([future, transform(future, lambda f: f.get() * 2),
+                                               fn(3, as_future=True)]))
+
+            fn.prime(100, 4)
+            self.assertEquals(100, fn(4))
+            fn.clear(4)
+            self.assertEquals(8, fn(4))
+            fn.clear_all()
+            self.assertEquals(2, fn(1))
+            self.assertEquals([[1, 2], [3], [4], [1]], CALLS)
+
+        test()
+        # A new context starts with an empty cache.
+        self.assertEquals(2, fn(1))
+        self.assertEquals([1], CALLS[-1])
+
+        @batch_context
+        def test_deadline():
+            # The sleeping greenlet holds up the batch until the first call's deadline has passed.
+            greenlets = [spawn(gevent.sleep, 0.02), spawn(fn, 5, batch_timeout=0.01), spawn(fn, 5)]
+            with may_block():
+                gevent.joinall(greenlets)
+            return [g.value if g.successful() else g.exception for g in greenlets]
+
+        results = test_deadline()
+        self.assertTrue(isinstance(results[1], DeadlineExceeded))
+        self.assertEquals(10, results[2])
+
     def test_batched_error(self):
         N_CALLS = [0]
         @batched(accepts_kwargs=False)
@@ -150,6 +304,531 @@ class BatchTests(TestCase):
         self.assertEquals([[(2,)], [(2,)], [(1,), (1,), (3,), (3,)]],
                           CALLS)
 
+    def test_time_window_scheduler(self):
+        @batched()
+        def fn(arg_list):
+            return [1] * len(arg_list)
+
+        DONE = []
+        def busy():
+            # Never blocks on a batch, so AllAtOnceScheduler would wait for it to finish.
+            for _ in xrange(50):
+                if DONE:
+                    return True
+                gevent.sleep(0.001)
+            return False
+
+        def call_fn():
+            fn()
+            DONE.append(True)
+
+        @batch_context
+        def test():
+            g1, g2 = spawn(busy), spawn(call_fn)
+            g2.get()
+            return g1.get()
+
+        set_default_scheduler(TimeWindowScheduler)
+        try:
+            self.assertTrue(test())
+        finally:
+            set_default_scheduler(AllAtOnceScheduler)
+
+        DONE[:] = []
+        self.assertFalse(test())
+
+    def test_shared_scheduler(self):
+        CALLS = []
+        @batched(accepts_kwargs=False, max_per_context=2)
+        def fn(arg_list):
+            CALLS.append([args[0] for args in arg_list])
+            return [args[0] if args[0] != 'bad' else Raise(ValueError()) for args in arg_list]
+
+        @batch_context
+        def request(items):
+            return pmap(fn, items)
+
+        set_default_scheduler(SharedScheduler)
+        try:
+            a, b = gevent.spawn(request, [1, 2, 3]), gevent.spawn(request, [4])
+            c = gevent.spawn(request, ['bad'])
+            self.assertEquals([1, 2, 3], a.get())
+            self.assertEquals([4], b.get())
+            self.assertRaises(ValueError, c.get)
+        finally:
+            set_default_scheduler(AllAtOnceScheduler)
+
+        self.assertEquals([[1, 2, 4, 'bad'], [3]], CALLS)
+
+        # Other schedulers ignore max_per_context.
+        del CALLS[:]
+        self.assertEquals([1, 2, 3], request([1, 2, 3]))
+        self.assertEquals([[1, 2, 3]], CALLS)
+
+    def test_shared_scheduler_futures(self):
+        READY = []
+        @batched(accepts_kwargs=False, max_per_context=2)
+        def fn(arg_list):
+            READY.append([f.ready() for f in futures])
+            return [args[0] * 2 for args in arg_list]
+
+        @batch_context
+        def request():
+            futures[:] = [fn(i, as_future=True) for i in xrange(3)]
+            return pget(futures[::-1])[::-1]
+
+        futures = []
+        set_default_scheduler(SharedScheduler)
+        try:
+            self.assertEquals([0, 2, 4], gevent.spawn(request).get())
+        finally:
+            set_default_scheduler(AllAtOnceScheduler)
+
+        # The first two calls are done before the leftover one runs.
+        self.assertEquals([[False, False, False], [True, True, False]], READY)
+
+    def test_shared_scheduler_links_follow_leftover_calls(self):
+        cache = LRUCache(10)
+        @batched(accepts_kwargs=False, max_per_context=1, cache=cache)
+        def fn(arg_list):
+            return [args[0] * 2 for args in arg_list]
+
+        @batch_context
+        def request():
+            futures = [transform(fn(i, as_future=True), lambda f: f.get() + 1) for i in xrange(3)]
+            return [f.get() for f in futures]
+
+        set_default_scheduler(SharedScheduler)
+        try:
+            self.assertEquals([1, 3, 5], gevent.spawn(request).get())
+        finally:
+            set_default_scheduler(AllAtOnceScheduler)
+
+        # The results of the leftover calls got written back to the cache too.
+        self.assertEquals(3, len(cache))
+
+    def test_executor(self):
+        @batched(accepts_kwargs=False, executor='thread')
+        def thread_fn(arg_list):
+            return [(args[0], thread.get_ident()) for args in arg_list]
+
+        @batch_context
+        def test(fn):
+            return pmap(fn, [1, 2])
+
+        (a, a_thread), (b, b_thread) = test(thread_fn)
+        self.assertEquals((1, 2), (a, b))
+        self.assertEquals(a_thread, b_thread)
+        self.assertNotEquals(thread.get_ident(), a_thread)
+
+        (a, a_pid), (b, b_pid) = test(_process_fn)
+        self.assertEquals((1, 2), (a, b))
+        self.assertEquals(a_pid, b_pid)
+        self.assertNotEquals(os.getpid(), a_pid)
+
+    def test_streaming_batch(self):
+        EVENTS = []
+        @batched(accepts_kwargs=False)
+        def fn(arg_list):
+            for args in arg_list:
+                gevent.sleep(0.001)
+                EVENTS.append(('yield', args[0]))
+                yield args[0] if args[0] != 'bad' else Raise(ValueError())
+            EVENTS.append('done')
+
+        @batched(accepts_kwargs=False, stream='indexed')
+        def indexed_fn(arg_list):
+            for i, args in reversed(list(enumerate(arg_list))):
+                yield i, args[0] * 2
+
+        @batched(accepts_kwargs=False)
+        def short_fn(arg_list):
+            yield 1
+
+        def get(x):
+            v = fn(x)
+            EVENTS.append(('got', v))
+            return v
+
+        @batch_context
+        def test():
+            self.assertEquals([1, 2], pmap(get, [1, 2]))
+            self.assertEquals([('yield', 1), ('got', 1), ('yield', 2), 'done', ('got', 2)], EVENTS)
+
+            a, b = fn('bad', as_future=True), fn(3, as_future=True)
+            self.assertRaises(ValueError, a.get)
+            self.assertEquals(3, b.get())
+
+            self.assertEquals([2, 4, 6], pmap(indexed_fn, [1, 2, 3]))
+            self.assertEquals([2, 4], pget([indexed_fn(1, as_future=True), indexed_fn(2, as_future=True)]))
+
+            a, b = short_fn(1, as_future=True), short_fn(2, as_future=True)
+            self.assertEquals(1, a.get())
+            self.assertRaises(ValueError, b.get)
+
+        test()
+
+    def test_keyed_batched(self):
+        CALLS = []
+        @keyed_batched()
+        def fn(keys):
+            CALLS.append(keys)
+            return {k: k * 2 for k in keys if k != 3}
+
+        class Thing(object):
+            @class_keyed_batched()
+            def fn(self, keys):
+                CALLS.append(keys)
+                return {k: k * 3 for k in keys}
+
+        @batch_context
+        def test():
+            a, b = fn([1, 2], as_future=True), fn(iter([2, 3]), as_future=True)
+            self.assertEquals({1: 2, 2: 4}, a.get())
+            self.assertEquals({2: 4}, b.get())
+            self.assertEquals([2], list(b.get()))
+            self.assertRaises(KeyError, lambda: b.get()[1])
+            self.assertEquals([frozenset([1, 2, 3])], CALLS)
+
+            self.assertEquals([{1: 3}, {1: 3, 2: 6}], pmap(Thing().fn, [[1], [1, 2]]))
+            self.assertEquals(frozenset([1, 2]), CALLS[-1])
+
+        test()
+
+    def test_retry(self):
+        CALLS = []
+        FAILURES = [1]
+        retry = RetryPolicy(max_attempts=2, backoff=0.001, retry_on=(IOError,))
+        @batched(accepts_kwargs=False, retry=retry)
+        def fn(arg_list):
+            values = [args[0] for args in arg_list]
+            CALLS.append(values)
+            if FAILURES[0]:
+                FAILURES[0] -= 1
+                raise IOError()
+            if 'bad' in values:
+                raise ValueError()
+            return values
+
+        @batch_context
+        def test(items):
+            greenlets = [spawn(fn, i) for i in items]
+            for g in greenlets:
+                g.join()
+            return [g.value if g.successful() else g.exception for g in greenlets]
+
+        self.assertEquals([1, 2], test([1, 2]))
+        self.assertEquals([[1, 2], [1, 2]], CALLS)
+        self.assertEquals((2, 1, 0), (retry.attempts, retry.retries, retry.bisections))
+
+        del CALLS[:]
+        results = test([1, 2, 'bad', 3])
+        self.assertEquals([1, 2, 3], results[:2] + results[3:])
+        self.assertTrue(isinstance(results[2], ValueError))
+        # ValueError is not transient so it's not retried. The batch gets bisected instead.
+        self.assertEquals([[1, 2, 'bad', 3], [1, 2], ['bad', 3], ['bad'], [3]], CALLS)
+        self.assertEquals((2, 1), (retry.bisections, retry.failures))
+
+    def test_circuit_breaker(self):
+        CALLS = []
+        FAIL = [True]
+        breaker = CircuitBreaker(min_batches=2, reset_timeout=0.01)
+        @batched(breaker=breaker)
+        def fn(arg_list):
+            CALLS.append(len(arg_list))
+            if FAIL[0]:
+                raise IOError()
+            return [1] * len(arg_list)
+
+        self.assertRaises(IOError, fn)
+        self.assertRaises(IOError, fn)
+        self.assertEquals({'fn': 'open'}, breaker.states())
+        self.assertRaises(CircuitOpenError, fn)
+        self.assertEquals(2, len(CALLS))
+
+        gevent.sleep(0.02)
+        FAIL[0] = False
+        # The probe batch succeeds & closes the circuit.
+        self.assertEquals([1, 1], spawn(pmap, fn, [1, 2]).get())
+        self.assertEquals({'fn': 'closed'}, breaker.states())
+        self.assertEquals([1, 1, 2], CALLS)
+
+        # A probe that never runs doesn't leave the circuit half-open.
+        FAIL[0] = True
+        self.assertRaises(IOError, fn)
+        self.assertRaises(IOError, fn)
+        gevent.sleep(0.02)
+        self.assertRaises(DeadlineExceeded, fn, batch_timeout=-1)
+        self.assertEquals({'fn': 'open'}, breaker.states())
+        FAIL[0] = False
+        self.assertEquals(1, fn())
+        self.assertEquals({'fn': 'closed'}, breaker.states())
+
+        # Nor does a probe that never finishes, e.g. because its greenlet was killed.
+        circuit = breaker.circuits.values()[0]
+        circuit._open()
+        gevent.sleep(0.02)
+        self.assertTrue(circuit.allow())
+        self.assertFalse(circuit.allow())
+        gevent.sleep(0.02)
+        self.assertTrue(circuit.allow())
+
+        @batched(breaker=CircuitBreaker(min_batches=1, fallback='fallback'))
+        def fallback_fn(arg_list):
+            raise IOError()
+
+        self.assertRaises(IOError, fallback_fn)
+        self.assertEquals('fallback', fallback_fn())
+
+        by_host = CircuitBreaker(min_batches=1, instance_key=lambda self: self.host)
+        class Client(object):
+            def __init__(self, host):
+                self.host = host
+
+            @class_batched(breaker=CircuitBreaker(min_batches=1))
+            def get(self, arg_list):
+                raise IOError()
+
+            @class_batched(breaker=by_host)
+            def get_by_host(self, arg_list):
+                raise IOError()
+
+        # New instances with the same key get the same circuit, rather than a new one each.
+        self.assertRaises(IOError, Client('a').get_by_host)
+        for _ in xrange(10):
+            self.assertRaises(CircuitOpenError, Client('a').get_by_host)
+        self.assertRaises(IOError, Client('b').get_by_host)
+        self.assertEquals({"Client.get_by_host['a']": 'open', "Client.get_by_host['b']": 'open'},
+                          by_host.states())
+        # Without instance_key, all instances share the method's circuit.
+        self.assertRaises(IOError, Client('a').get)
+        self.assertRaises(CircuitOpenError, Client('b').get)
+
+        # Fallback values don't end up in caches.
+        FAIL[0] = True
+        cache = LRUCache(10)
+        @batched(accepts_kwargs=False, cache=cache,
+                 breaker=CircuitBreaker(min_batches=1, reset_timeout=0.01, fallback='fallback'))
+        def cached_fn(arg_list):
+            if FAIL[0]:
+                raise IOError()
+            return [args[0] * 2 for args in arg_list]
+
+        self.assertRaises(IOError, cached_fn, 1)
+        self.assertEquals('fallback', cached_fn(1))
+        self.assertEquals(['fallback', 'fallback'], spawn(pmap, cached_fn, [1, 2]).get())
+        self.assertEquals(0, len(cache))
+        gevent.sleep(0.02)
+        FAIL[0] = False
+        self.assertEquals([2, 4], spawn(pmap, cached_fn, [1, 2]).get())
+
+    def test_deadlines(self):
+        CALLS = []
+        REMAINING = []
+        @batched(accepts_kwargs=False)
+        def fn(arg_list):
+            CALLS.append([x[0] for x in arg_list])
+            REMAINING.append(time_remaining())
+            gevent.sleep(0.02)
+            return [x[0] for x in arg_list]
+
+        self.assertRaises(DeadlineExceeded, fn, 1, batch_timeout=0.01)
+        self.assertEquals(1, fn(1, batch_timeout=1))
+        self.assertTrue(0.5 < REMAINING[-1] <= 1)
+
+        @batch_context
+        def test():
+            with deadline(0.01):
+                # The sleeping greenlet holds up the batch until the deadline has passed.
+                greenlets = [spawn(gevent.sleep, 0.02), spawn(fn, 2), spawn(fn, 3, batch_timeout=0.5)]
+                gevent.joinall(greenlets)
+            return [g.value if g.successful() else g.exception for g in greenlets]
+
+        del CALLS[:]
+        results = test()
+        self.assertTrue(isinstance(results[1], DeadlineExceeded))
+        self.assertTrue(isinstance(results[2], DeadlineExceeded))
+        self.assertEquals([], CALLS)
+
+        @batch_context
+        def test_drop():
+            # Only the call without a deadline makes it into the batch.
+            greenlets = [spawn(gevent.sleep, 0.02), spawn(fn, 4, batch_timeout=0.01), spawn(fn, 5)]
+            with may_block():
+                gevent.joinall(greenlets)
+            return [g.value if g.successful() else g.exception for g in greenlets]
+
+        results = test_drop()
+        self.assertTrue(isinstance(results[1], DeadlineExceeded))
+        self.assertEquals(5, results[2])
+        self.assertEquals([[5]], CALLS)
+
+        def with_deadline(seconds, wait):
+            with deadline(seconds):
+                with may_block():
+                    wait.wait()
+                return time_remaining()
+
+        @batch_context
+        def test_concurrent():
+            # Deadlines belong to the greenlet, so exiting one block doesn't affect another greenlet.
+            wait_1, wait_2 = gevent.event.Event(), gevent.event.Event()
+            g1, g2 = spawn(with_deadline, 5, wait_1), spawn(with_deadline, 0.5, wait_2)
+            gevent.sleep(0)
+            wait_1.set()
+            g1.join()
+            wait_2.set()
+            return g1.get(), g2.get(), time_remaining()
+
+        remaining_1, remaining_2, remaining = test_concurrent()
+        self.assertTrue(4 < remaining_1 <= 5)
+        self.assertTrue(0 < remaining_2 <= 0.5)
+        self.assertEquals(None, remaining)
+
+    def test_cancelled_calls(self):
+        CALLS = []
+        @batched(accepts_kwargs=False)
+        def fn(arg_list):
+            CALLS.append([x[0] for x in arg_list])
+            return [x[0] for x in arg_list]
+
+        @batch_context
+        def test():
+            sleeper = spawn(gevent.sleep, 0.01)
+            greenlets = [spawn(fn, 1), spawn(fn, 2), spawn(fn, 3)]
+            gevent.sleep(0)
+            greenlets[1].kill()
+            fn(4, as_future=True)  # Nobody waits for it, but it still runs.
+            sleeper.join()
+            return [g.get() for g in greenlets[::2]]
+
+        before = cancelled_calls()
+        self.assertEquals([1, 3], test())
+        self.assertEquals([[1, 3, 4]], CALLS)
+        self.assertEquals(1, cancelled_calls()['calls'] - before['calls'])
+
+        @batch_context
+        def test_skip():
+            greenlet = spawn(fn, 5)
+            gevent.sleep(0)
+            sleeper = spawn(gevent.sleep, 0.01)
+            greenlet.kill()
+            sleeper.join()
+            with may_block():
+                gevent.sleep(0.01)  # Lets the (empty) batch run.
+
+        test_skip()
+        self.assertEquals([[1, 3, 4]], CALLS)
+        self.assertEquals(1, cancelled_calls()['batches'] - before['batches'])
+
+        @batch_context
+        def test_linked():
+            sleeper = spawn(gevent.sleep, 0.01)
+            future = fn(6, as_future=True)
+            transformed = transform(future, lambda f: f.get() * 2)
+            cancelled = fn(7, as_future=True)
+            def waiter(f):
+                with gevent.Timeout(0.001, False):
+                    f.get()
+            # Both give up, but the transform() still wants the result of the first call.
+            pget([spawn(waiter, future), spawn(waiter, cancelled)])
+            sleeper.join()
+            return transformed.get(), cancelled
+
+        transformed, cancelled = test_linked()
+        self.assertEquals(12, transformed)
+        self.assertEquals([[1, 3, 4], [6]], CALLS)
+        self.assertRaises(CallCancelled, cancelled.get)
+
+    def test_hang_detection(self):
+        warnings = []
+        handler = logging.Handler()
+        handler.emit = lambda record: warnings.append(record.getMessage())
+        logging.getLogger('gbatchy.context').addHandler(handler)
+        set_hang_threshold(0.01)
+
+        event = gevent.event.Event()
+        def waiter():
+            with may_block():
+                event.wait(0.05)
+
+        @batched()
+        def fn(arg_list):
+            gevent.sleep(0.02)  # Not blocked on a batch, so not a hang.
+
+        @batch_context
+        def test():
+            spawn(fn).join()
+            spawn(waiter).join()
+
+        try:
+            test()
+        finally:
+            set_hang_threshold(None)
+            logging.getLogger('gbatchy.context').removeHandler(handler)
+
+        self.assertEquals(1, len(warnings))
+        self.assertTrue('waiter> waiting on <gevent.event.Event' in warnings[0])
+
+    def test_hang_detection_ignores_running_batches(self):
+        warnings = []
+        handler = logging.Handler()
+        handler.emit = lambda record: warnings.append(record.getMessage())
+        logging.getLogger('gbatchy.context').addHandler(handler)
+        set_hang_threshold(0.01)
+
+        @batched(accepts_kwargs=False, stream='ordered')
+        def streaming(arg_list):
+            for args in arg_list:
+                gevent.sleep(0.02)
+                yield args[0]
+
+        FAILURES = [1]
+        @batched(accepts_kwargs=False, retry=RetryPolicy(max_attempts=2, backoff=0.02, retry_on=(IOError,)))
+        def flaky(arg_list):
+            if FAILURES[0]:
+                FAILURES[0] -= 1
+                raise IOError()
+            return [args[0] for args in arg_list]
+
+        @batched(accepts_kwargs=False)
+        def slow(arg_list):
+            gevent.sleep(0.02)
+            return [args[0] for args in arg_list]
+
+        @batch_context
+        def test():
+            self.assertEquals([1, 2], pmap(streaming, [1, 2]))
+            self.assertEquals(1, flaky(1))
+
+        @batch_context
+        def test_shared():
+            self.assertEquals(1, slow(1))
+
+        try:
+            test()
+            set_default_scheduler(SharedScheduler)
+            test_shared()
+        finally:
+            set_default_scheduler(AllAtOnceScheduler)
+            set_hang_threshold(None)
+            logging.getLogger('gbatchy.context').removeHandler(handler)
+
+        self.assertEquals([], warnings)
+
+    def test_top_level_calls_run_inline(self):
+        CONTEXTS = []
+        @batched(accepts_kwargs=False)
+        def fn(arg_list):
+            CONTEXTS.append(get_context())
+            return [Raise(ValueError(x[0])) if x[0] < 0 else x[0] for x in arg_list]
+
+        self.assertEquals(1, fn(1))
+        self.assertEquals(2, fn(2, as_future=True).get())
+        self.assertRaises(ValueError, fn, -1)
+        self.assertRaises(ValueError, fn(-1, as_future=True).get)
+        self.assertEquals([None] * 4, CONTEXTS)
+
     def test_batch_return_value(self):
         @batched(accepts_kwargs=False)
         def fn(arg_list):
@@ -210,6 +889,66 @@ class BatchTests(TestCase):
 
         test()
 
+    def test_pmap_batched_without_greenlets(self):
+        GREENLETS = []
+        @batched(accepts_kwargs=False)
+        def double(args_list):
+            GREENLETS.append(get_context().num_greenlets)
+            return [args[0] * 2 if args[0] != 'bad' else Raise(ValueError()) for args in args_list]
+
+        class Thing(object):
+            @class_batched()
+            def is_even(self, args_list):
+                GREENLETS.append(get_context().num_greenlets)
+                return [args[0] % 2 == 0 for args, kwargs in args_list]
+
+        @batch_context
+        def test():
+            self.assertEquals([2, 4, 6], pmap(double, [1, 2, 3]))
+            self.assertEquals([2], pfilter(Thing().is_even, [1, 2, 3]))
+            self.assertRaises(ValueError, pmap, double, [1, 'bad'])
+            # Only this greenlet & the batch greenlet.
+            self.assertEquals([2, 2, 2], GREENLETS)
+
+            del GREENLETS[:]
+            with deadline(10):
+                self.assertEquals([2, 4], pmap(double, [1, 2]))
+            self.assertEquals([4], GREENLETS)  # One greenlet per call, so their waits have a deadline.
+
+            # Wrappers get batch_fn too (functools.wraps copies it), but don't take as_future.
+            @functools.wraps(double)
+            def logged(i):
+                return double(i)
+            del GREENLETS[:]
+            self.assertEquals([2, 4], pmap(logged, [1, 2]))
+            self.assertEquals([4], GREENLETS)
+
+        test()
+
+    def test_spawn_many(self):
+        @batched(accepts_kwargs=False)
+        def add_one(args_list):
+            return [args[0] + 1 for args in args_list]
+
+        CONTEXTS = []
+        def fn(i, n=0):
+            CONTEXTS.append(get_context())
+            return add_one(i) + n
+
+        @batch_context
+        def test():
+            greenlets = spawn_many(fn, [1, 2, 3], n=10)
+            self.assertEquals(3, get_context().num_greenlets - 1)
+            return pget(greenlets)
+
+        self.assertEquals([12, 13, 14], test())
+        self.assertEquals(1, len(set(CONTEXTS)))
+
+        # Outside of a context, they all share a new one.
+        del CONTEXTS[:]
+        self.assertEquals([2, 3], [g.get() for g in spawn_many(fn, [1, 2])])
+        self.assertEquals(1, len(set(CONTEXTS)))
+
     def test_pool_spawn(self):
         @batched()
         def add_n(args_list):
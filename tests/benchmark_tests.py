@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+from benchmarks import measure, compare
+from benchmarks.load import Workload, simulate
+from benchmarks.micro import BENCHMARKS, bench_run_next
+from gbatchy.stats import add_stats_listener, remove_stats_listener, StatsListener
+
+
+class BenchmarkTests(TestCase):
+    def test_micro_benchmarks_run(self):
+        for name, (fn, n) in BENCHMARKS.iteritems():
+            if n <= 50000:
+                result = measure(fn, 100, repeat=1)
+                self.assertTrue(result['ops_per_sec'] > 0, name)
+
+    def test_run_next_does_n_ops(self):
+        sizes = []
+        listener = StatsListener()
+        listener.batch_completed = lambda name, size, duration, failed: sizes.append(size)
+        add_stats_listener(listener)
+        try:
+            bench_run_next(30)(100)
+        finally:
+            remove_stats_listener(listener)
+        self.assertEquals([30, 30, 30, 10], sizes)
+
+    def test_compare(self):
+        baseline = {'a': {'ops_per_sec': 100.0, 'live_objects_per_op': 1.0},
+                    'b': {'ops_per_sec': 100.0, 'live_objects_per_op': 1.0}}
+        results = {'a': {'ops_per_sec': 95.0, 'live_objects_per_op': 1.0},
+                   'b': {'ops_per_sec': 50.0, 'live_objects_per_op': 3.0},
+                   'c': {'ops_per_sec': 1.0, 'live_objects_per_op': 1.0}}
+        self.assertEquals([('b', 'ops_per_sec', 100.0, 50.0), ('b', 'live_objects_per_op', 1.0, 3.0)],
+                          compare(results, baseline))
+
+    def test_load_simulation(self):
+        workload = Workload(depth=2, fanout=2, keys_per_level=3, latency=0.001)
+        result = simulate(workload, requests=10, concurrency=5)
+        self.assertEquals(4, result['rounds_per_request'])
+        self.assertEquals(4, result['backend_calls_per_request'])
+        self.assertTrue(result['p50_ms'] <= result['p99_ms'])
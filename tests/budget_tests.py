@@ -0,0 +1,55 @@
+from unittest import TestCase
+
+from gbatchy.batch import batched
+from gbatchy.budget import round_budget, RoundBudgetExceeded
+from gbatchy.context import batch_context, spawn
+from gbatchy.utils import pmap
+
+
+class RoundBudgetTests(TestCase):
+    def setUp(self):
+        @batched(accepts_kwargs=False)
+        def fn(arg_list):
+            return [x[0] for x in arg_list]
+        self.fn = fn
+
+    def test_max_rounds(self):
+        fn = self.fn
+
+        @round_budget(max_rounds=1)
+        def batched_once():
+            return pmap(fn, [1, 2, 3])
+
+        @round_budget(max_rounds=1)
+        def sequential():
+            return [fn(1), fn(2)]
+
+        self.assertEquals([1, 2, 3], batched_once())
+        with self.assertRaises(RoundBudgetExceeded) as cm:
+            sequential()
+        self.assertTrue('2 rounds (max 1)' in str(cm.exception))
+        self.assertTrue('sequential (' in str(cm.exception))
+
+    def test_n_plus_one(self):
+        fn = self.fn
+
+        @batch_context
+        def test(max_single_batches):
+            with round_budget(max_single_batches=max_single_batches, max_batches_per_fn=5):
+                return [fn(i) for i in xrange(4)]
+
+        self.assertEquals([0, 1, 2, 3], test(4))
+        with self.assertRaises(RoundBudgetExceeded) as cm:
+            test(3)
+        self.assertTrue('4 batches of size 1 of fn' in str(cm.exception))
+        self.assertTrue('budget_tests.py' in str(cm.exception))
+
+        @round_budget(max_rounds=0, action='log')
+        def logged():
+            return spawn(fn, 1).get()
+        self.assertEquals(1, logged())
+
+        @round_budget(max_rounds=0, sample_rate=0)
+        def unsampled():
+            return fn(1)
+        self.assertEquals(1, unsampled())
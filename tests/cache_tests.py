@@ -0,0 +1,85 @@
+import time
+from unittest import TestCase
+
+from gbatchy.batch import batched, class_batched
+from gbatchy.cache import LRUCache
+from gbatchy.context import batch_context
+from gbatchy.utils import pget, pmap
+
+class LRUCacheTests(TestCase):
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(1, cache.get('a'))
+        cache.set('c', 3)  # evicts b, since a was just used.
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals(3, cache.get('c'))
+        self.assertEquals(2, len(cache))
+        self.assertEquals((2, 1), (cache.hits, cache.misses))
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        self.assertTrue('a' in cache)
+        time.sleep(0.02)
+        self.assertFalse('a' in cache)
+        self.assertEquals('default', cache.get('a', 'default'))
+
+    def test_none(self):
+        cache = LRUCache()
+        cache.set('a', None)
+        self.assertFalse('a' in cache)
+
+        cache = LRUCache(cache_none=True)
+        cache.set('a', None)
+        self.assertTrue('a' in cache)
+
+    def test_batched(self):
+        CALLS = []
+        cache = LRUCache(maxsize=10)
+        @batched(accepts_kwargs=False, cache=cache)
+        def fn(arg_list):
+            CALLS.append([args[0] for args in arg_list])
+            return [args[0] * 2 if args[0] else None for args in arg_list]
+
+        @batch_context
+        def test():
+            return pmap(fn, [0, 1, 2])
+
+        self.assertEquals([None, 2, 4], test())
+        self.assertEquals([None, 2, 4], test())
+        self.assertEquals(2, fn(1))
+        self.assertEquals(4, fn(2, as_future=True).get())
+        self.assertEquals([[0, 1, 2], [0]], CALLS)
+        self.assertEquals(4, cache.hits)
+
+        # Cache hits can be passed to pget() like any other future.
+        self.assertEquals([2, 4], batch_context(pget)([fn(1, as_future=True), fn(2, as_future=True)]))
+
+        @batched(cache=cache)
+        def with_kwargs(arg_list):
+            return [args[0] for args, kwargs in arg_list]
+
+        # Unhashable arguments just skip the cache.
+        self.assertEquals(1, with_kwargs(1, opts=[1, 2]))
+        self.assertEquals(1, with_kwargs(1, opts=[1, 2]))
+        self.assertEquals(6, cache.hits)
+
+    def test_class_batched(self):
+        cache = LRUCache(maxsize=10)
+        self.assertRaises(ValueError, class_batched, cache=cache)
+
+        class C(object):
+            def __init__(self, name):
+                self.name = name
+
+            @class_batched(accepts_kwargs=False, cache=cache, cache_key=lambda self: self.name)
+            def get(self, arg_list):
+                return [self.name for _ in arg_list]
+
+        self.assertEquals('A', C('A').get(1))
+        # The first instance is gone, so this one may well get the same id().
+        self.assertEquals('B', C('B').get(1))
+        self.assertEquals('A', C('A').get(1))
+        self.assertEquals(1, cache.hits)
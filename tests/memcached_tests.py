@@ -41,6 +41,17 @@ class MemcachedClientTests(TestCase):
 
         self.assertEquals(3, test())
 
+    def test_get_multi_returns_dicts(self):
+        self.client.set(self.key_prefix + b'a', 1, time=100)
+
+        def test():
+            a = spawn(self.client.get_multi, [self.key_prefix + b'a', self.key_prefix + b'b'])
+            b = spawn(self.client.get_multi, [self.key_prefix + b'b'], as_future=True)
+            return a.get(), b.get().get()
+
+        self.assertEquals(({self.key_prefix + b'a': 1}, {}), test())
+        self.assertIs(dict, type(test()[0]))
+
     def test_multi_delete(self):
         def set_thing(a, b):
             self.client.set(self.key_prefix + b'hi' + a, b, time=100)
@@ -0,0 +1,54 @@
+from unittest import TestCase
+
+import gevent
+
+from gbatchy.batch import batched
+from gbatchy.context import batch_context, spawn
+from gbatchy.stats import add_stats_listener, remove_stats_listener, BatchStats, Histogram
+
+
+class StatsTests(TestCase):
+    def setUp(self):
+        self.stats = BatchStats()
+        add_stats_listener(self.stats)
+
+    def tearDown(self):
+        remove_stats_listener(self.stats)
+
+    def test_histogram(self):
+        h = Histogram()
+        self.assertEquals(None, h.percentile(0.5))
+        for v in [0, 1, 2, 3, 100]:
+            h.add(v)
+        self.assertEquals(5, h.count)
+        self.assertEquals(21.2, h.mean)
+        self.assertEquals(4, h.percentile(0.5))
+        self.assertEquals(100, h.percentile(0.99))
+
+    def test_batch_stats(self):
+        @batched(accepts_kwargs=False)
+        def fn(arg_list):
+            if any(x[0] is None for x in arg_list):
+                raise ValueError()
+            return [x[0] for x in arg_list]
+
+        @batch_context
+        def test():
+            a, b = spawn(fn, 1), spawn(fn, 2)
+            c = spawn(fn, a.get() + b.get())
+            return c.get()
+
+        self.assertEquals(3, test())
+        self.assertRaises(ValueError, fn, None)
+        gevent.sleep(0)  # Contexts finish in a hub callback.
+
+        summary = self.stats.summary()
+        self.assertEquals(['fn'], summary['functions'].keys())
+        fn_stats = summary['functions']['fn']
+        self.assertEquals(3, fn_stats['batches'])
+        self.assertEquals(1, fn_stats['errors'])
+        self.assertEquals(2, fn_stats['size']['max'])
+        # The call outside of a batch context runs inline, without being queued or a context.
+        self.assertEquals(2, fn_stats['queued']['count'])
+        self.assertEquals(1, summary['rounds']['count'])
+        self.assertEquals(2, summary['rounds']['max'])
@@ -0,0 +1,35 @@
+from StringIO import StringIO
+from unittest import TestCase
+import json
+
+from gbatchy.batch import batched
+from gbatchy.context import batch_context, spawn
+from gbatchy.trace import tracing
+
+
+class TraceTests(TestCase):
+    def test_chrome_trace(self):
+        @batched(accepts_kwargs=False)
+        def fn(arg_list):
+            return [x[0] for x in arg_list]
+
+        @batch_context
+        def handler():
+            a, b = spawn(fn, 1), spawn(fn, 2)
+            return fn(a.get() + b.get())
+
+        with tracing() as tracer:
+            self.assertEquals(3, handler())
+
+        self.assertEquals(1, len(tracer.finished))
+        out = StringIO()
+        tracer.dump(out)
+        events = json.loads(out.getvalue())['traceEvents']
+
+        self.assertEquals(['round 1', 'round 2'], [e['name'] for e in events if e.get('cat') == 'round'])
+        batch_fns = [e for e in events if e.get('cat') == 'batch_fn']
+        self.assertEquals([2, 1], [e['args']['size'] for e in batch_fns])
+        self.assertTrue(all(e['name'] == 'fn' and e['ph'] == 'X' for e in batch_fns))
+        flushes = [e for e in events if e['name'] == 'flush fn']
+        self.assertEquals(['round', 'round'], [e['args']['reason'] for e in flushes])
+        self.assertTrue(len(set(e['pid'] for e in events)) == 1)